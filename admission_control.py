@@ -0,0 +1,224 @@
+"""
+Admission Control
+Genie MCPサーバーとModel Serving Endpointへの呼び出しを調整するアドミッション制御
+プロセス共通のトークンバケット、ユーザーごとの同時実行数上限、公平なFIFOキューを組み合わせる
+"""
+
+import contextvars
+import os
+import threading
+import time
+from collections import deque
+from contextlib import contextmanager
+from typing import Callable, Deque, Dict, Iterator, Optional
+
+
+QueueListener = Callable[[int], None]
+
+_current_user: contextvars.ContextVar[str] = contextvars.ContextVar("admission_user", default="anonymous")
+_queue_listener: contextvars.ContextVar[Optional[QueueListener]] = contextvars.ContextVar(
+    "admission_queue_listener", default=None
+)
+
+
+class AdmissionTimeout(Exception):
+    """キューで待機中にタイムアウトした場合の例外"""
+
+
+def set_current_user(user_key: str):
+    """現在のコンテキストで呼び出しを行うユーザーを設定"""
+    _current_user.set(user_key or "anonymous")
+
+
+def get_current_user() -> str:
+    """現在のコンテキストのユーザーを取得"""
+    return _current_user.get()
+
+
+@contextmanager
+def queue_feedback(listener: Optional[QueueListener]) -> Iterator[None]:
+    """
+    ブロック内の呼び出しがキューで待たされたときに順番を通知する
+
+    Args:
+        listener: キュー内の順番（1始まり）を受け取る関数（Noneの場合は通知しない）
+    """
+    token = _queue_listener.set(listener)
+    try:
+        yield
+    finally:
+        _queue_listener.reset(token)
+
+
+class TokenBucket:
+    """一定レートで補充されるトークンバケット（ロックは呼び出し側で保持する）"""
+
+    def __init__(self, rate: float, capacity: float):
+        """
+        Args:
+            rate: 1秒あたりに補充されるトークン数
+            capacity: バケットの容量（許容するバースト）
+        """
+        self.rate = rate
+        self.capacity = capacity
+        self._tokens = capacity
+        self._updated = time.monotonic()
+
+    def _refill(self, now: float):
+        self._tokens = min(self.capacity, self._tokens + (now - self._updated) * self.rate)
+        self._updated = now
+
+    def wait_time(self) -> float:
+        """トークンが1つ使えるようになるまでの秒数"""
+        self._refill(time.monotonic())
+        if self._tokens >= 1:
+            return 0.0
+        return (1 - self._tokens) / self.rate
+
+    def consume(self):
+        self._refill(time.monotonic())
+        self._tokens -= 1
+
+
+class _Ticket:
+    __slots__ = ("user_key",)
+
+    def __init__(self, user_key: str):
+        self.user_key = user_key
+
+
+class AdmissionController:
+    """レート・同時実行数・ユーザーごとの上限を満たすまで呼び出しをFIFOで待たせるクラス"""
+
+    def __init__(
+        self,
+        name: str,
+        rate: float,
+        burst: float,
+        max_concurrent: int,
+        per_user_concurrency: int,
+        queue_timeout: float
+    ):
+        """
+        Args:
+            name: 制御対象の名前（エラーメッセージ用）
+            rate: 1秒あたりに開始できる呼び出し数
+            burst: 一度に開始できる呼び出し数
+            max_concurrent: プロセス全体の同時実行数上限
+            per_user_concurrency: ユーザーごとの同時実行数上限
+            queue_timeout: キューで待機する最大秒数
+        """
+        self.name = name
+        self.max_concurrent = max_concurrent
+        self.per_user_concurrency = per_user_concurrency
+        self.queue_timeout = queue_timeout
+        self._bucket = TokenBucket(rate, burst)
+        self._queue: Deque[_Ticket] = deque()
+        self._in_flight = 0
+        self._in_flight_by_user: Dict[str, int] = {}
+        self._cond = threading.Condition()
+
+    def _next_eligible(self) -> Optional[_Ticket]:
+        """上限に達していないユーザーのうち、最も先に並んだチケット"""
+        for ticket in self._queue:
+            if self._in_flight_by_user.get(ticket.user_key, 0) < self.per_user_concurrency:
+                return ticket
+        return None
+
+    def _acquire(self, user_key: str, timeout: float, listener: Optional[QueueListener]):
+        ticket = _Ticket(user_key)
+        deadline = time.monotonic() + timeout
+        last_position = 0
+        with self._cond:
+            self._queue.append(ticket)
+        try:
+            while True:
+                position = 0
+                with self._cond:
+                    wait = None
+                    if self._next_eligible() is ticket and self._in_flight < self.max_concurrent:
+                        wait = self._bucket.wait_time()
+                        if wait <= 0:
+                            self._bucket.consume()
+                            self._queue.remove(ticket)
+                            self._in_flight += 1
+                            self._in_flight_by_user[user_key] = self._in_flight_by_user.get(user_key, 0) + 1
+                            self._cond.notify_all()
+                            return
+                    remaining = deadline - time.monotonic()
+                    if remaining <= 0:
+                        raise AdmissionTimeout(f"{self.name}: 混雑のためリクエストを開始できませんでした")
+                    current_position = self._queue.index(ticket) + 1
+                    if listener is None or current_position == last_position:
+                        self._cond.wait(timeout=min(wait, remaining) if wait is not None else remaining)
+                    else:
+                        position = current_position
+                # 通知はロックの外で行う（UI更新で他のスレッドを止めないため）
+                if position:
+                    last_position = position
+                    listener(position)
+        except BaseException:
+            with self._cond:
+                if ticket in self._queue:
+                    self._queue.remove(ticket)
+                self._cond.notify_all()
+            raise
+
+    def _release(self, user_key: str):
+        with self._cond:
+            self._in_flight -= 1
+            count = self._in_flight_by_user.get(user_key, 0) - 1
+            if count > 0:
+                self._in_flight_by_user[user_key] = count
+            else:
+                self._in_flight_by_user.pop(user_key, None)
+            self._cond.notify_all()
+
+    @contextmanager
+    def admit(self, user_key: Optional[str] = None, timeout: Optional[float] = None) -> Iterator[None]:
+        """
+        実行枠を確保してブロックを実行
+
+        Args:
+            user_key: 呼び出しユーザー（省略時は現在のコンテキストのユーザー）
+            timeout: キューで待機する最大秒数（省略時は設定値）
+
+        Raises:
+            AdmissionTimeout: 待機がタイムアウトした場合
+        """
+        user_key = user_key or get_current_user()
+        self._acquire(
+            user_key,
+            self.queue_timeout if timeout is None else timeout,
+            _queue_listener.get()
+        )
+        try:
+            yield
+        finally:
+            self._release(user_key)
+
+    def snapshot(self) -> Dict[str, int]:
+        """現在の待ち行列と実行中の数"""
+        with self._cond:
+            return {"queued": len(self._queue), "in_flight": self._in_flight}
+
+
+def _controller_from_env(name: str, prefix: str, rate: float, burst: float,
+                         max_concurrent: int, per_user_concurrency: int) -> AdmissionController:
+    return AdmissionController(
+        name=name,
+        rate=float(os.getenv(f"{prefix}_RATE_PER_SEC", rate)),
+        burst=float(os.getenv(f"{prefix}_BURST", burst)),
+        max_concurrent=int(os.getenv(f"{prefix}_MAX_CONCURRENT", max_concurrent)),
+        per_user_concurrency=int(os.getenv(f"{prefix}_PER_USER_CONCURRENCY", per_user_concurrency)),
+        queue_timeout=float(os.getenv("ADMISSION_QUEUE_TIMEOUT", 120))
+    )
+
+
+# プロセス共通のコントローラー
+genie_admission = _controller_from_env(
+    "Genie", "GENIE", rate=2, burst=5, max_concurrent=8, per_user_concurrency=1
+)
+llm_admission = _controller_from_env(
+    "LLM", "LLM", rate=5, burst=10, max_concurrent=16, per_user_concurrency=2
+)
@@ -1,13 +1,28 @@
+from __future__ import annotations
+
 import os
+import time
+from contextlib import contextmanager
+# 起動時刻を記録するため、他のモジュールより先に読み込む
+from startup import (
+    PROCESS_START_WALL, lazy_import, lazy_module, start_background_warmup, get_import_report,
+    mark_first_paint, get_first_paint_seconds
+)
 import streamlit as st
-import pandas as pd
-from databricks.sdk import WorkspaceClient
-from databricks.sdk.core import Config
 import json
-from typing import Dict, Any, List
+from typing import Dict, Any, List, Optional
 from mcp_client import GenieMCPClient, GenieMCPResponseParser
-from model_serving_utils import query_endpoint
-import requests
+from model_serving_utils import query_endpoint, get_deploy_client
+from temporal_parser import parse_temporal_columns
+from conversation_context import AnalysisConversation, DEFAULT_TOKEN_BUDGET
+from speculative_followup import SpeculativeFollowups, is_speculation_enabled
+from admission_control import set_current_user, queue_feedback
+from request_coalescing import genie_single_flight, normalize_question
+from warehouse_client import SQLWarehouseClient, DEFAULT_MAX_WORKERS, DEFAULT_MAX_ROWS, DEFAULT_MAX_BYTES
+from result_viewer import ResultPager, export_dataframe, EXPORT_FORMATS, PAGE_SIZE_OPTIONS, DEFAULT_PAGE_SIZE
+
+# pandas / Databricks SDK / mlflow は必要になった時点でインポート
+pd = lazy_module("pandas")
 # Load environment variables from .env file for local development
 try:
     from dotenv import load_dotenv
@@ -29,33 +44,65 @@ genie_space_id = st.sidebar.text_input(
     value=default_genie_space_id,
     help="DatabricksのGenie Space IDを入力してください"
 )
+# 先読みはLLMの呼び出しが増えるため、運用側で有効にした場合のみユーザーが切り替えられる
+speculative_mode = is_speculation_enabled() and st.sidebar.toggle(
+    "⚡ おすすめ質問の回答を先読み",
+    value=True,
+    help="AIが提案した追加質問への回答をバックグラウンドで事前に生成します"
+)
 
-def get_workspace_info() -> tuple:
-    """ワークスペース情報を取得"""
+def get_workspace_hostname() -> Optional[str]:
+    """ワークスペースのホスト名を取得（環境変数があればSDKを読み込まない）"""
+    workspace_hostname = os.getenv("DATABRICKS_HOST")
+    if workspace_hostname:
+        return workspace_hostname
     try:
-        workspace_client = WorkspaceClient()
-        current_user = workspace_client.current_user.me()
-        workspace_hostname = Config().host
-        return workspace_hostname, current_user.user_name
+        return lazy_import("databricks.sdk.core").Config().host
     except Exception as e:
         st.error(f"ワークスペース情報の取得に失敗しました: {str(e)}")
-        return None, None
-
-def extract_dataframe_from_genie_response(result: Dict[str, Any]) -> pd.DataFrame:
+        return None
+
+def show_import_report():
+    """起動時のインポート時間レポートをサイドバーに表示"""
+    with st.sidebar.expander("⏱️ 起動時間レポート", expanded=False):
+        st.markdown(f"- プロセス起動時刻: {time.strftime('%Y-%m-%d %H:%M:%S', time.localtime(PROCESS_START_WALL))}")
+        first_paint = get_first_paint_seconds()
+        if first_paint is not None:
+            st.markdown(f"- 起動から初回描画までの時間: {first_paint:.3f}s")
+        for item in get_import_report():
+            if item.get("error"):
+                st.markdown(f"- `{item['module']}`: 失敗 ({item['error']})")
+            else:
+                st.markdown(f"- `{item['module']}`: {item['seconds']:.3f}s")
+
+def report_warning(message: str, warnings: Optional[List[str]] = None):
+    """警告を表示（warningsが渡された場合は呼び出し元で表示するために追加する）"""
+    if warnings is None:
+        st.warning(message)
+    else:
+        warnings.append(message)
+
+def extract_dataframe_from_genie_response(
+    result: Dict[str, Any],
+    space_id: str = "",
+    warnings: Optional[List[str]] = None
+) -> pd.DataFrame:
     content = result.get("content")
     if isinstance(content, list) and content and "text" in content[0]:
         text = content[0]["text"]
         
         # デバッグ: レスポンスの内容を確認
         if not text or text.strip() == "":
-            st.warning("Genieのレスポンスが空です")
+            report_warning("Genieのレスポンスが空です", warnings)
             return pd.DataFrame()
             
         try:
             parsed = json.loads(text)
             sr = parsed.get("statement_response")
             if sr and "manifest" in sr and "result" in sr:
-                columns = [col["name"] for col in sr["manifest"]["schema"]["columns"]]
+                manifest_columns = sr["manifest"]["schema"]["columns"]
+                columns = [col["name"] for col in manifest_columns]
+                column_types = {col["name"]: col.get("type_name") for col in manifest_columns}
                 rows = []
                 for row in sr["result"].get("data_array", []):
                     row_values = []
@@ -70,23 +117,14 @@ def extract_dataframe_from_genie_response(result: Dict[str, Any]) -> pd.DataFram
                             row_values.append(None)
                     rows.append(row_values)
                 df = pd.DataFrame(rows, columns=columns)
+                # 日付変換（マニフェストの型を優先し、不明な文字列列はフォーマットを推定）
+                temporal_columns = parse_temporal_columns(df, space_id, column_types)
                 # 数値変換
                 for col in df.columns:
-                    df[col] = pd.to_numeric(df[col], errors='ignore')
-                # 日付変換の改善
-                for col in df.columns:
-                    if any(x in col.lower() for x in ['date', 'month', 'time', 'day', 'year']):
+                    if col not in temporal_columns:
                         try:
-                            # まず文字列として扱い、複数の日付フォーマットを試行
-                            df[col] = pd.to_datetime(df[col], errors='coerce', infer_datetime_format=True, utc=True)
-                            # UTCからローカルタイムゾーンに変換してからnaiveに変換
-                            if df[col].notna().any():
-                                df[col] = df[col].dt.tz_convert(None)  # naiveなdatetimeに変換
-                                continue
-                            else:
-                                # 全てNaTの場合は元に戻す
-                                df[col] = pd.to_numeric(df[col], errors='ignore')
-                        except Exception:
+                            df[col] = pd.to_numeric(df[col])
+                        except (ValueError, TypeError):
                             pass
                 return df
             # fallback: 旧ロジック
@@ -95,10 +133,10 @@ def extract_dataframe_from_genie_response(result: Dict[str, Any]) -> pd.DataFram
             # JSONパースエラーを静かに処理
             pass
         except Exception as e:
-            st.warning(f"データ抽出エラー: {e}")
+            report_warning(f"データ抽出エラー: {e}", warnings)
     return pd.DataFrame()
 
-def extract_query_from_genie_response(result: Dict[str, Any]) -> str:
+def extract_query_from_genie_response(result: Dict[str, Any], warnings: Optional[List[str]] = None) -> str:
     """Genie MCPレスポンスから実行されたクエリーを抽出"""
     content = result.get("content")
     if isinstance(content, list) and content and "text" in content[0]:
@@ -118,10 +156,10 @@ def extract_query_from_genie_response(result: Dict[str, Any]) -> str:
             # JSONパースエラーの場合は静かに処理
             pass
         except Exception as e:
-            st.warning(f"クエリー抽出エラー: {e}")
+            report_warning(f"クエリー抽出エラー: {e}", warnings)
     return ""
 
-def extract_comment_from_genie_response(result: Dict[str, Any]) -> str:
+def extract_comment_from_genie_response(result: Dict[str, Any], warnings: Optional[List[str]] = None) -> str:
     """Genie MCPレスポンスからコメントを抽出"""
     content = result.get("content")
     if isinstance(content, list) and content and "text" in content[0]:
@@ -148,7 +186,7 @@ def extract_comment_from_genie_response(result: Dict[str, Any]) -> str:
             # JSONパースエラーの場合は静かに処理
             pass
         except Exception as e:
-            st.warning(f"コメント抽出エラー: {e}")
+            report_warning(f"コメント抽出エラー: {e}", warnings)
     
     # JSONとして解析できない場合は、プレーンテキストとして扱う
     if isinstance(content, list) and content and "text" in content[0]:
@@ -179,11 +217,9 @@ def format_sql_query(query: str) -> str:
     
     return formatted_query
 
-def analyze_dataframe_with_llm(df: pd.DataFrame, question: str) -> tuple[str, list[str]]:
-    """DataFrameをLLMで分析してコメントと次の質問候補を生成"""
-    try:
-        # DataFrameを文字列形式に変換
-        df_summary = f"""
+def build_data_profile(df: pd.DataFrame) -> str:
+    """DataFrameをLLM向けのデータプロファイル文字列に変換"""
+    return f"""
 データ概要:
 - 行数: {len(df)}
 - 列数: {len(df.columns)}
@@ -195,25 +231,74 @@ def analyze_dataframe_with_llm(df: pd.DataFrame, question: str) -> tuple[str, li
 基本統計:
 {df.describe().to_string()}
 """
-        
-        # 分析プロンプトを作成
-        analysis_prompt = f"""
-あなたはデータアナリストです。以下のデータについて分析し、必ずJSON形式で回答してください。
 
-元の質問: {question}
 
-{df_summary}
+def summarize_analysis_turns(previous_summary: str, messages: List[Dict[str, str]]) -> str:
+    """古い分析チャットのターンをLLMで要約"""
+    conversation = "\n".join(
+        f"{'ユーザー' if msg['role'] == 'user' else 'AI'}: {msg['content']}" for msg in messages
+    )
+    summary_prompt = f"""
+以下はデータ分析チャットのこれまでの要約と、その後の会話です。
+今後の質問に答えるために必要な事実・数値・結論を残して、400文字以内の日本語で要約を更新してください。
+
+これまでの要約:
+{previous_summary or "（なし）"}
+
+会話:
+{conversation}
+"""
+    response = query_endpoint(
+        endpoint_name=os.getenv("SERVING_ENDPOINT"),
+        messages=[{"role": "user", "content": summary_prompt}],
+        max_tokens=300,
+    )
+    return response["content"]
+
+
+def create_analysis_context(df: pd.DataFrame, question: str) -> AnalysisConversation:
+    """分析チャット用の会話コンテキストを作成"""
+    return AnalysisConversation(
+        data_profile=build_data_profile(df),
+        original_question=question,
+        token_budget=int(os.getenv("ANALYSIS_CONTEXT_TOKEN_BUDGET", DEFAULT_TOKEN_BUDGET)),
+        summarizer=summarize_analysis_turns
+    )
+
+
+def get_analysis_context(df: pd.DataFrame, question: str) -> AnalysisConversation:
+    """セッションの分析チャット用会話コンテキストを取得（なければ作成）"""
+    context = st.session_state.get("analysis_context")
+    if context is None or context.original_question != question:
+        context = create_analysis_context(df, question)
+        st.session_state["analysis_context"] = context
+    return context
+
+
+def analyze_dataframe_with_llm(
+    df: pd.DataFrame,
+    question: str,
+    context: Optional[AnalysisConversation] = None
+) -> tuple[str, list[str]]:
+    """DataFrameをLLMで分析してコメントと次の質問候補を生成"""
+    try:
+        if context is None:
+            context = create_analysis_context(df, question)
+
+        # 分析プロンプトを作成（データプロファイルと元の質問は会話コンテキストのプレフィックスに含まれる）
+        analysis_prompt = """
+上記のデータについて分析し、必ずJSON形式で回答してください。
 
 回答は必ず以下のJSON形式にしてください（他の文章は一切含めないでください）：
 
-{{
+{
   "analysis": "データの分析結果を200文字以内で日本語で記述",
   "follow_up_questions": [
     "このデータを見た人が次に聞きたくなる具体的な質問1",
     "このデータを見た人が次に聞きたくなる具体的な質問2",
     "このデータを見た人が次に聞きたくなる具体的な質問3"
   ]
-}}
+}
 
 分析では以下を含めてください:
 - データの主要な傾向や特徴
@@ -224,7 +309,7 @@ follow_up_questionsは、実際にこのデータを見た人が詳しく知り
 """
         
         # LLMに送信するメッセージ形式
-        messages = [{"role": "user", "content": analysis_prompt}]
+        messages = context.build_messages(analysis_prompt)
         
         # SERVING_ENDPOINTに問い合わせ
         response = query_endpoint(
@@ -235,65 +320,413 @@ follow_up_questionsは、実際にこのデータを見た人が詳しく知り
         
         # JSONレスポンスをパース
         try:
-            import json
             result = json.loads(response["content"])
             analysis = result.get("analysis", "分析結果を取得できませんでした")
             follow_up_questions = result.get("follow_up_questions", [])
-            return analysis, follow_up_questions
         except json.JSONDecodeError:
             # JSONパースに失敗した場合は、レスポンス全体を分析結果として返す
-            return response["content"], []
+            analysis, follow_up_questions = response["content"], []
+        # 会話履歴には分析結果のみを残す
+        context.add_turn("このデータを分析してください。", analysis)
+        return analysis, follow_up_questions
             
     except Exception as e:
         return f"分析中にエラーが発生しました: {str(e)}", []
 
 
-def analyze_dataframe_with_followup(df: pd.DataFrame, original_question: str, followup_question: str) -> str:
-    """DataFrameに対する追加質問に回答"""
-    try:
-        # DataFrameを文字列形式に変換
-        df_summary = f"""
-データ概要:
-- 行数: {len(df)}
-- 列数: {len(df.columns)}
-- 列名: {', '.join(df.columns.tolist())}
-
-データサンプル (最初の5行):
-{df.head().to_string()}
-
-基本統計:
-{df.describe().to_string()}
-"""
-        
-        # 追加質問プロンプトを作成
-        followup_prompt = f"""
-以下のデータについて追加の質問に答えてください。
-
-元の質問: {original_question}
+def answer_followup(context: AnalysisConversation, followup_question: str) -> str:
+    """
+    会話コンテキストを踏まえて追加質問に回答（会話履歴には追記しない）
+    先読みからも呼ばれるため、失敗時は例外をそのまま送出する
+    """
+    # 追加質問プロンプトを作成
+    followup_prompt = f"""
 追加の質問: {followup_question}
 
-{df_summary}
-
 追加質問に対して、データに基づいた具体的で有用な回答を日本語で提供してください。
 可能であれば具体的な数値やパターンを含めてください。
 300文字以内で回答してください。
 """
-        
-        # LLMに送信するメッセージ形式
-        messages = [{"role": "user", "content": followup_prompt}]
-        
-        # SERVING_ENDPOINTに問い合わせ
-        response = query_endpoint(
-            endpoint_name=os.getenv("SERVING_ENDPOINT"),
-            messages=messages,
-            max_tokens=400,
-        )
-        
-        return response["content"]
+    
+    # LLMに送信するメッセージ形式
+    messages = context.build_messages(followup_prompt)
+    
+    # SERVING_ENDPOINTに問い合わせ
+    response = query_endpoint(
+        endpoint_name=os.getenv("SERVING_ENDPOINT"),
+        messages=messages,
+        max_tokens=400,
+    )
+    return response["content"]
+
+
+def analyze_dataframe_with_followup(
+    df: pd.DataFrame,
+    original_question: str,
+    followup_question: str,
+    context: Optional[AnalysisConversation] = None
+) -> str:
+    """DataFrameに対する追加質問に回答（会話コンテキストがあれば過去のターンを踏まえる）"""
+    try:
+        if context is None:
+            context = create_analysis_context(df, original_question)
+        answer = answer_followup(context, followup_question)
+        # 次のターンのために会話コンテキストへ追記
+        context.add_turn(followup_question, answer)
+        return answer
     except Exception as e:
         return f"追加質問の回答中にエラーが発生しました: {str(e)}"
 
 
+def get_user_key() -> str:
+    """リクエストヘッダーからユーザーを識別するキーを取得"""
+    try:
+        headers = st.context.headers
+        return (
+            headers.get("X-Forwarded-Email")
+            or headers.get("X-Forwarded-Preferred-Username")
+            or headers.get("X-Forwarded-User")
+            or "anonymous"
+        )
+    except Exception:
+        return "anonymous"
+
+
+@contextmanager
+def show_queue_position():
+    """混雑でキュー待ちになった場合に順番を表示"""
+    notice = st.empty()
+    with queue_feedback(lambda position: notice.info(f"⏳ 混雑しています。現在 {position} 番目に並んでいます...")):
+        try:
+            yield
+        finally:
+            notice.empty()
+
+
+def get_speculative_followups() -> SpeculativeFollowups:
+    """セッションの先読み管理オブジェクトを取得（なければ作成）"""
+    if "speculative_followups" not in st.session_state:
+        st.session_state["speculative_followups"] = SpeculativeFollowups(get_user_key())
+    return st.session_state["speculative_followups"]
+
+
+def cancel_speculative_followups():
+    """データが差し替えられたときに先読みを破棄"""
+    if "speculative_followups" in st.session_state:
+        st.session_state["speculative_followups"].cancel()
+
+
+def get_result_pager(df: pd.DataFrame) -> ResultPager:
+    """セッションのページャーを取得（データが変わったら作り直す）"""
+    pager = st.session_state.get("genie_result_pager")
+    if pager is None or pager.df is not df:
+        pager = ResultPager(df)
+        st.session_state["genie_result_pager"] = pager
+        st.session_state["grid_page"] = 1
+    return pager
+
+
+def display_result_grid(df: pd.DataFrame):
+    """結果をサーバー側でソート・ページングし、表示中のページだけを送信"""
+    pager = get_result_pager(df)
+
+    sort_col, order_col, size_col = st.columns([2, 1, 1])
+    with sort_col:
+        sort_by = st.selectbox("並び替え", ["なし"] + df.columns.tolist(), key="grid_sort_by")
+    with order_col:
+        ascending = st.selectbox("順序", ["昇順", "降順"], key="grid_sort_order") == "昇順"
+    with size_col:
+        page_size = st.selectbox(
+            "表示件数",
+            PAGE_SIZE_OPTIONS,
+            index=PAGE_SIZE_OPTIONS.index(DEFAULT_PAGE_SIZE),
+            key="grid_page_size"
+        )
+
+    page_count = pager.page_count(page_size)
+    # 表示件数の変更でページ数が減った場合は範囲内に戻す
+    if st.session_state.get("grid_page", 1) > page_count:
+        st.session_state["grid_page"] = page_count
+    page = st.number_input("ページ", min_value=1, max_value=page_count, step=1, key="grid_page")
+    page_df = pager.page(page, page_size, None if sort_by == "なし" else sort_by, ascending)
+    st.dataframe(page_df, use_container_width=True)
+    start_row = (page - 1) * page_size + 1 if pager.row_count else 0
+    st.caption(f"全 {pager.row_count:,} 行中 {start_row:,}～{start_row + len(page_df) - 1:,} 行目を表示（{page}/{page_count} ページ）")
+
+    # ダウンロードはクリック時にチャンク単位で生成
+    export_cols = st.columns(len(EXPORT_FORMATS))
+    for export_col, (fmt, info) in zip(export_cols, EXPORT_FORMATS.items()):
+        with export_col:
+            st.download_button(
+                f"⬇️ {info['label']}",
+                data=lambda fmt=fmt: export_dataframe(df, fmt),
+                file_name=f"genie_result.{info['extension']}",
+                mime=info["mime"],
+                key=f"download_{fmt}"
+            )
+
+
+def get_result_stats(df: pd.DataFrame) -> Dict[str, Any]:
+    """統計情報を計算（同じデータに対しては再計算しない）"""
+    cached = st.session_state.get("genie_result_stats")
+    if cached is None or cached["df"] is not df:
+        datetime_columns = df.select_dtypes(include=['datetime64[ns]', 'datetime']).columns
+        cached = {
+            "df": df,
+            "describe": df.describe(),
+            "dtypes": df.dtypes,
+            "nulls": df.isnull().sum(),
+            "date_ranges": [(col, df[col].min(), df[col].max()) for col in datetime_columns],
+        }
+        st.session_state["genie_result_stats"] = cached
+    return cached
+
+
+@st.fragment
+def display_data_panel(df: pd.DataFrame, executed_query: str):
+    """データ表示パネル（ページ送り・並び替え・ダウンロードはこのパネルだけを再実行）"""
+    display_result_grid(df)
+    
+    # 実行されたクエリーを表示（データの下に表示）
+    if executed_query:
+        with st.expander("🔍 実行されたクエリー", expanded=False):
+            formatted_query = format_sql_query(executed_query)
+            st.code(formatted_query, language="sql")
+
+
+@st.fragment
+def display_stats_panel(df: pd.DataFrame):
+    """統計情報パネル"""
+    with st.expander("📋 統計情報"):
+        stats = get_result_stats(df)
+        st.write("**基本統計:**")
+        st.write(stats["describe"])
+        st.write("**データ型:**")
+        st.write(stats["dtypes"])
+        st.write("**欠損値:**")
+        st.write(stats["nulls"])
+        if stats["date_ranges"]:
+            st.write("**日付列の情報:**")
+            for col, min_value, max_value in stats["date_ranges"]:
+                st.write(f"- {col}: {min_value} ～ {max_value}")
+
+
+@st.fragment
+def display_visualization_panel(df: pd.DataFrame):
+    """可視化パネル（チャートの設定変更はこのパネルだけを再実行）"""
+    numeric_columns = df.select_dtypes(include=['number']).columns
+    categorical_columns = df.select_dtypes(include=['object', 'category']).columns
+    datetime_columns = df.select_dtypes(include=['datetime64[ns]', 'datetime']).columns
+    
+    st.subheader("📈 可視化")
+    chart_type = st.selectbox(
+        "チャートタイプ",
+        ["line", "bar", "scatter", "histogram", "pie"],
+        key="chart_type"
+    )
+
+    # Group By機能の追加
+    group_by_options = ["なし"] + list(categorical_columns) + list(datetime_columns)
+    group_by_col = st.selectbox("Group By（グループ化）", group_by_options, key="group_by_col")
+    if chart_type == "line" and len(numeric_columns) > 0:
+        # 日付列がある場合はX軸として使用可能
+        if len(datetime_columns) > 0:
+            x_axis_col = st.selectbox("X軸（時間軸）", datetime_columns)
+            y_axis_cols = st.multiselect(
+                "Y軸（数値）を選択",
+                numeric_columns,
+                default=list(numeric_columns[:3])
+            )
+            if x_axis_col and y_axis_cols:
+                if group_by_col != "なし":
+                    # Group Byありの場合
+                    chart_data = df.groupby([x_axis_col, group_by_col])[y_axis_cols].sum().reset_index()
+                    chart_data = chart_data.pivot(index=x_axis_col, columns=group_by_col, values=y_axis_cols[0])
+                    st.line_chart(chart_data)
+                else:
+                    # Group Byなしの場合
+                    chart_data = df.set_index(x_axis_col)[y_axis_cols]
+                    st.line_chart(chart_data)
+        else:
+            selected_columns = st.multiselect(
+                "表示する列を選択",
+                numeric_columns,
+                default=list(numeric_columns[:3])
+            )
+            if selected_columns:
+                if group_by_col != "なし":
+                    # Group Byありの場合
+                    chart_data = df.groupby(group_by_col)[selected_columns].sum()
+                    st.line_chart(chart_data)
+                else:
+                    # Group Byなしの場合
+                    st.line_chart(df[selected_columns])
+    elif chart_type == "bar" and len(numeric_columns) > 0:
+        # X軸の選択肢を準備（カテゴリ列と日付列）
+        x_axis_options = list(categorical_columns) + list(datetime_columns)
+        if len(x_axis_options) == 0:
+            x_axis_options = df.columns.tolist()
+        x_col = st.selectbox("X軸（カテゴリ・日付）", x_axis_options)
+        y_col = st.selectbox("Y軸（数値）", numeric_columns)
+        if x_col and y_col:
+            if group_by_col != "なし" and group_by_col != x_col:
+                # Group Byありの場合
+                chart_data = df.groupby([x_col, group_by_col])[y_col].sum().reset_index()
+                chart_data = chart_data.pivot(index=x_col, columns=group_by_col, values=y_col)
+                st.bar_chart(chart_data)
+            else:
+                # Group Byなしの場合
+                chart_data = df.groupby(x_col)[y_col].sum().reset_index()
+                st.bar_chart(chart_data.set_index(x_col))
+    elif chart_type == "scatter" and len(numeric_columns) >= 2:
+        x_col = st.selectbox("X軸", numeric_columns, key="scatter_x")
+        y_col = st.selectbox("Y軸", [col for col in numeric_columns if col != x_col], key="scatter_y")
+        if x_col and y_col:
+            if group_by_col != "なし":
+                # Group Byありの場合は、色分けで表示
+                st.write("散布図では、Group Byによる色分けは現在サポートされていません")
+                st.scatter_chart(df, x=x_col, y=y_col)
+            else:
+                # Group Byなしの場合
+                st.scatter_chart(df, x=x_col, y=y_col)
+    elif chart_type == "histogram" and len(numeric_columns) > 0:
+        col = st.selectbox("列を選択", numeric_columns, key="histogram_col")
+        if col:
+            if group_by_col != "なし":
+                # Group Byありの場合は、グループ別にヒストグラムを表示
+                st.write("ヒストグラムでは、Group Byによる分割表示は現在サポートされていません")
+                st.histogram_chart(df[col])
+            else:
+                # Group Byなしの場合
+                st.histogram_chart(df[col])
+    elif chart_type == "pie" and len(categorical_columns) > 0:
+        category_col = st.selectbox("カテゴリ列", categorical_columns, key="pie_category")
+        if len(numeric_columns) > 0:
+            value_col = st.selectbox("値列", numeric_columns, key="pie_value")
+            if category_col and value_col:
+                if group_by_col != "なし" and group_by_col != category_col:
+                    # Group Byありの場合は、複数の円グラフを表示
+                    st.write("円グラフでは、Group Byによる分割表示は現在サポートされていません")
+                    pie_data = df.groupby(category_col)[value_col].sum()
+                    st.write("円グラフデータ:")
+                    st.write(pie_data)
+                    st.bar_chart(pie_data)
+                else:
+                    # Group Byなしの場合
+                    pie_data = df.groupby(category_col)[value_col].sum()
+                    st.write("円グラフデータ:")
+                    st.write(pie_data)
+                    st.bar_chart(pie_data)
+
+
+@st.fragment
+def display_analysis_chat(df: pd.DataFrame, question: str):
+    """AI分析・追加質問チャット（チャットの操作はこのパネルだけを再実行）"""
+    # フラグメントだけの再実行ではmain()を通らないため、LLM呼び出しのユーザーをここでも設定
+    set_current_user(get_user_key())
+    st.subheader("🤖 AI分析コメント")
+    if st.button("分析を実行", key="analyze_button"):
+        with st.spinner("データを分析中..."), show_queue_position():
+            # 新しい分析を開始するので会話コンテキストを作り直す
+            analysis_context = create_analysis_context(df, question)
+            st.session_state["analysis_context"] = analysis_context
+            analysis_comment, follow_up_questions = analyze_dataframe_with_llm(df, question, analysis_context)
+            st.session_state["analysis_comment"] = analysis_comment
+            st.session_state["follow_up_questions"] = follow_up_questions
+            # 分析チャット履歴を初期化
+            if "analysis_messages" not in st.session_state:
+                st.session_state["analysis_messages"] = []
+            # 最初の分析結果をチャット履歴に追加
+            st.session_state["analysis_messages"].append({"role": "assistant", "content": analysis_comment})
+        # 提案された質問への回答をバックグラウンドで先読み（キュー表示の外で開始する）
+        speculative = get_speculative_followups()
+        speculative.cancel()
+        if speculative_mode and follow_up_questions:
+            speculative.start(
+                follow_up_questions,
+                lambda q: answer_followup(analysis_context, q)
+            )
+
+    # 保存された分析コメントがあれば表示
+    if "analysis_comment" in st.session_state:
+        st.info(st.session_state["analysis_comment"])
+
+        # 分析結果に対する追加質問機能
+        st.subheader("💭 AIに追加で質問")
+
+        # AIが生成したサンプル質問の表示
+        if "follow_up_questions" in st.session_state and st.session_state["follow_up_questions"]:
+            st.markdown("**次におすすめの質問：**")
+            sample_questions = st.session_state["follow_up_questions"]
+        else:
+            st.markdown("**よく使われる質問例：**")
+            sample_questions = [
+                "このデータの主要な課題は何ですか？",
+                "改善すべき点を具体的に教えてください",
+                "注目すべき特徴やパターンはありますか？"
+            ]
+
+        speculative = get_speculative_followups()
+        cols = st.columns(len(sample_questions))
+        for i, sample_q in enumerate(sample_questions):
+            with cols[i]:
+                speculative_status = speculative.status(sample_q)
+                button_help = {"ready": "⚡ 回答を先読み済み", "running": "⏳ 回答を先読み中"}.get(speculative_status)
+                if st.button(f"📝 {sample_q}", key=f"sample_q_{i}", help=button_help):
+                    # サンプル質問をチャット履歴に追加
+                    if "analysis_messages" not in st.session_state:
+                        st.session_state["analysis_messages"] = []
+                    st.session_state["analysis_messages"].append({"role": "user", "content": sample_q})
+
+                    # AIの応答を生成（先読み済みの回答があればそれを使う）
+                    with st.spinner("回答を生成中..."), show_queue_position():
+                        analysis_context = get_analysis_context(df, question)
+                        follow_up_response = speculative.get(sample_q, timeout=60)
+                        if follow_up_response is not None:
+                            analysis_context.add_turn(sample_q, follow_up_response)
+                        else:
+                            follow_up_response = analyze_dataframe_with_followup(
+                                df, question, sample_q, analysis_context
+                            )
+                        st.session_state["analysis_messages"].append({"role": "assistant", "content": follow_up_response})
+                    st.rerun(scope="fragment")
+
+        # 分析チャット履歴の初期化
+        if "analysis_messages" not in st.session_state:
+            st.session_state["analysis_messages"] = []
+
+        # 分析チャット履歴の表示（最初のAI分析コメントは除外）
+        for i, msg in enumerate(st.session_state["analysis_messages"]):
+            # 最初のassistantメッセージ（AI分析コメント）はスキップ
+            if i == 0 and msg["role"] == "assistant":
+                continue
+            with st.chat_message(msg["role"]):
+                st.markdown(msg["content"])
+
+        # 追加質問の入力
+        if analysis_prompt := st.chat_input("このデータについて追加で質問してください...", key="analysis_chat"):
+            # ユーザーの質問を履歴に追加
+            st.session_state["analysis_messages"].append({"role": "user", "content": analysis_prompt})
+            with st.chat_message("user"):
+                st.markdown(analysis_prompt)
+
+            # AIの応答を生成
+            with st.chat_message("assistant"):
+                with st.spinner("回答を生成中..."), show_queue_position():
+                    follow_up_response = analyze_dataframe_with_followup(
+                        df, question, analysis_prompt, get_analysis_context(df, question)
+                    )
+                    st.markdown(follow_up_response)
+                    st.session_state["analysis_messages"].append({"role": "assistant", "content": follow_up_response})
+
+        # 分析チャット履歴をクリア
+        if st.button("🗑️ 分析チャットをクリア", key="clear_analysis_chat"):
+            st.session_state["analysis_messages"] = []
+            if "analysis_context" in st.session_state:
+                st.session_state["analysis_context"].reset()
+            st.rerun(scope="fragment")
+
+
 def display_query_result():
     df = st.session_state.get("genie_df")
     question = st.session_state.get("genie_question", "")
@@ -306,223 +739,130 @@ def display_query_result():
         st.info(genie_comment)
     
     if df is not None and not df.empty:
-        # データ型を事前に取得（両方のカラムで使用するため）
-        numeric_columns = df.select_dtypes(include=['number']).columns
-        categorical_columns = df.select_dtypes(include=['object', 'category']).columns
-        datetime_columns = df.select_dtypes(include=['datetime64[ns]', 'datetime']).columns
-        
+        # 各パネルはフラグメントとして独立して再実行される
         col1, col2 = st.columns([1, 1])
         with col1:
             st.subheader("📊 データ")
-            st.dataframe(df, use_container_width=True)
-            
-            # 実行されたクエリーを表示（データの下に表示）
-            if executed_query:
-                with st.expander("🔍 実行されたクエリー", expanded=False):
-                    formatted_query = format_sql_query(executed_query)
-                    st.code(formatted_query, language="sql")
+            display_data_panel(df, executed_query)
             
             # 統計情報を表示（クエリーの下に表示）
-            with st.expander("📋 統計情報"):
-                st.write("**基本統計:**")
-                st.write(df.describe())
-                st.write("**データ型:**")
-                st.write(df.dtypes)
-                st.write("**欠損値:**")
-                st.write(df.isnull().sum())
-                if len(datetime_columns) > 0:
-                    st.write("**日付列の情報:**")
-                    for col in datetime_columns:
-                        st.write(f"- {col}: {df[col].min()} ～ {df[col].max()}")
+            display_stats_panel(df)
         
         with col2:
-            st.subheader("📈 可視化")
-            chart_type = st.selectbox(
-                "チャートタイプ",
-                ["line", "bar", "scatter", "histogram", "pie"],
-                key="chart_type"
-            )
-            
-            # Group By機能の追加
-            group_by_options = ["なし"] + list(categorical_columns) + list(datetime_columns)
-            group_by_col = st.selectbox("Group By（グループ化）", group_by_options, key="group_by_col")
-            if chart_type == "line" and len(numeric_columns) > 0:
-                # 日付列がある場合はX軸として使用可能
-                if len(datetime_columns) > 0:
-                    x_axis_col = st.selectbox("X軸（時間軸）", datetime_columns)
-                    y_axis_cols = st.multiselect(
-                        "Y軸（数値）を選択",
-                        numeric_columns,
-                        default=list(numeric_columns[:3])
-                    )
-                    if x_axis_col and y_axis_cols:
-                        if group_by_col != "なし":
-                            # Group Byありの場合
-                            chart_data = df.groupby([x_axis_col, group_by_col])[y_axis_cols].sum().reset_index()
-                            chart_data = chart_data.pivot(index=x_axis_col, columns=group_by_col, values=y_axis_cols[0])
-                            st.line_chart(chart_data)
-                        else:
-                            # Group Byなしの場合
-                            chart_data = df.set_index(x_axis_col)[y_axis_cols]
-                            st.line_chart(chart_data)
-                else:
-                    selected_columns = st.multiselect(
-                        "表示する列を選択",
-                        numeric_columns,
-                        default=list(numeric_columns[:3])
-                    )
-                    if selected_columns:
-                        if group_by_col != "なし":
-                            # Group Byありの場合
-                            chart_data = df.groupby(group_by_col)[selected_columns].sum()
-                            st.line_chart(chart_data)
-                        else:
-                            # Group Byなしの場合
-                            st.line_chart(df[selected_columns])
-            elif chart_type == "bar" and len(numeric_columns) > 0:
-                # X軸の選択肢を準備（カテゴリ列と日付列）
-                x_axis_options = list(categorical_columns) + list(datetime_columns)
-                if len(x_axis_options) == 0:
-                    x_axis_options = df.columns.tolist()
-                x_col = st.selectbox("X軸（カテゴリ・日付）", x_axis_options)
-                y_col = st.selectbox("Y軸（数値）", numeric_columns)
-                if x_col and y_col:
-                    if group_by_col != "なし" and group_by_col != x_col:
-                        # Group Byありの場合
-                        chart_data = df.groupby([x_col, group_by_col])[y_col].sum().reset_index()
-                        chart_data = chart_data.pivot(index=x_col, columns=group_by_col, values=y_col)
-                        st.bar_chart(chart_data)
-                    else:
-                        # Group Byなしの場合
-                        chart_data = df.groupby(x_col)[y_col].sum().reset_index()
-                        st.bar_chart(chart_data.set_index(x_col))
-            elif chart_type == "scatter" and len(numeric_columns) >= 2:
-                x_col = st.selectbox("X軸", numeric_columns, key="scatter_x")
-                y_col = st.selectbox("Y軸", [col for col in numeric_columns if col != x_col], key="scatter_y")
-                if x_col and y_col:
-                    if group_by_col != "なし":
-                        # Group Byありの場合は、色分けで表示
-                        st.write("散布図では、Group Byによる色分けは現在サポートされていません")
-                        st.scatter_chart(df, x=x_col, y=y_col)
-                    else:
-                        # Group Byなしの場合
-                        st.scatter_chart(df, x=x_col, y=y_col)
-            elif chart_type == "histogram" and len(numeric_columns) > 0:
-                col = st.selectbox("列を選択", numeric_columns, key="histogram_col")
-                if col:
-                    if group_by_col != "なし":
-                        # Group Byありの場合は、グループ別にヒストグラムを表示
-                        st.write("ヒストグラムでは、Group Byによる分割表示は現在サポートされていません")
-                        st.histogram_chart(df[col])
-                    else:
-                        # Group Byなしの場合
-                        st.histogram_chart(df[col])
-            elif chart_type == "pie" and len(categorical_columns) > 0:
-                category_col = st.selectbox("カテゴリ列", categorical_columns, key="pie_category")
-                if len(numeric_columns) > 0:
-                    value_col = st.selectbox("値列", numeric_columns, key="pie_value")
-                    if category_col and value_col:
-                        if group_by_col != "なし" and group_by_col != category_col:
-                            # Group Byありの場合は、複数の円グラフを表示
-                            st.write("円グラフでは、Group Byによる分割表示は現在サポートされていません")
-                            pie_data = df.groupby(category_col)[value_col].sum()
-                            st.write("円グラフデータ:")
-                            st.write(pie_data)
-                            st.bar_chart(pie_data)
-                        else:
-                            # Group Byなしの場合
-                            pie_data = df.groupby(category_col)[value_col].sum()
-                            st.write("円グラフデータ:")
-                            st.write(pie_data)
-                            st.bar_chart(pie_data)
-        
+            display_visualization_panel(df)
         
         # AI分析コメントを表示
-        st.subheader("🤖 AI分析コメント")
-        if st.button("分析を実行", key="analyze_button"):
-            with st.spinner("データを分析中..."):
-                analysis_comment, follow_up_questions = analyze_dataframe_with_llm(df, question)
-                st.session_state["analysis_comment"] = analysis_comment
-                st.session_state["follow_up_questions"] = follow_up_questions
-                # 分析チャット履歴を初期化
-                if "analysis_messages" not in st.session_state:
-                    st.session_state["analysis_messages"] = []
-                # 最初の分析結果をチャット履歴に追加
-                st.session_state["analysis_messages"].append({"role": "assistant", "content": analysis_comment})
-        
-        # 保存された分析コメントがあれば表示
-        if "analysis_comment" in st.session_state:
-            st.info(st.session_state["analysis_comment"])
-            
-            # 分析結果に対する追加質問機能
-            st.subheader("💭 AIに追加で質問")
-            
-            # AIが生成したサンプル質問の表示
-            if "follow_up_questions" in st.session_state and st.session_state["follow_up_questions"]:
-                st.markdown("**次におすすめの質問：**")
-                sample_questions = st.session_state["follow_up_questions"]
-            else:
-                st.markdown("**よく使われる質問例：**")
-                sample_questions = [
-                    "このデータの主要な課題は何ですか？",
-                    "改善すべき点を具体的に教えてください",
-                    "注目すべき特徴やパターンはありますか？"
-                ]
-            
-            cols = st.columns(len(sample_questions))
-            for i, sample_q in enumerate(sample_questions):
-                with cols[i]:
-                    if st.button(f"📝 {sample_q}", key=f"sample_q_{i}"):
-                        # サンプル質問をチャット履歴に追加
-                        if "analysis_messages" not in st.session_state:
-                            st.session_state["analysis_messages"] = []
-                        st.session_state["analysis_messages"].append({"role": "user", "content": sample_q})
-                        
-                        # AIの応答を生成
-                        with st.spinner("回答を生成中..."):
-                            follow_up_response = analyze_dataframe_with_followup(df, question, sample_q)
-                            st.session_state["analysis_messages"].append({"role": "assistant", "content": follow_up_response})
-                        st.rerun()
-            
-            # 分析チャット履歴の初期化
-            if "analysis_messages" not in st.session_state:
-                st.session_state["analysis_messages"] = []
-            
-            # 分析チャット履歴の表示（最初のAI分析コメントは除外）
-            for i, msg in enumerate(st.session_state["analysis_messages"]):
-                # 最初のassistantメッセージ（AI分析コメント）はスキップ
-                if i == 0 and msg["role"] == "assistant":
-                    continue
-                with st.chat_message(msg["role"]):
-                    st.markdown(msg["content"])
-            
-            # 追加質問の入力
-            if analysis_prompt := st.chat_input("このデータについて追加で質問してください...", key="analysis_chat"):
-                # ユーザーの質問を履歴に追加
-                st.session_state["analysis_messages"].append({"role": "user", "content": analysis_prompt})
-                with st.chat_message("user"):
-                    st.markdown(analysis_prompt)
-                
-                # AIの応答を生成
-                with st.chat_message("assistant"):
-                    with st.spinner("回答を生成中..."):
-                        follow_up_response = analyze_dataframe_with_followup(df, question, analysis_prompt)
-                        st.markdown(follow_up_response)
-                        st.session_state["analysis_messages"].append({"role": "assistant", "content": follow_up_response})
-            
-            # 分析チャット履歴をクリア
-            if st.button("🗑️ 分析チャットをクリア", key="clear_analysis_chat"):
-                st.session_state["analysis_messages"] = []
-                st.rerun()
+        display_analysis_chat(df, question)
         
     #else:
     #    st.info("表形式で表示できるデータがありません")
 
+def is_warehouse_fetch_enabled() -> bool:
+    """大きな結果をSQLウェアハウスから取得する設定が有効か"""
+    return (
+        os.getenv("WAREHOUSE_ARROW_FETCH", "false").lower() in ("1", "true", "yes")
+        and bool(os.getenv("DATABRICKS_WAREHOUSE_ID"))
+    )
+
+
+def is_large_genie_result(result: Dict[str, Any]) -> bool:
+    """Genieの結果が切り詰められているか、行数がしきい値を超えているか"""
+    content = result.get("content")
+    if isinstance(content, list) and content and "text" in content[0]:
+        text = content[0]["text"]
+        if not text or text.strip() == "":
+            return False
+        try:
+            parsed = json.loads(text)
+            sr = parsed.get("statement_response")
+            if not sr:
+                return False
+            manifest = sr.get("manifest", {})
+            row_count = len((sr.get("result") or {}).get("data_array", []))
+            threshold = int(os.getenv("WAREHOUSE_FETCH_ROW_THRESHOLD", 10000))
+            return (
+                bool(manifest.get("truncated"))
+                or manifest.get("total_row_count", row_count) > row_count
+                or row_count >= threshold
+            )
+        except (json.JSONDecodeError, AttributeError, TypeError, ValueError):
+            pass
+    return False
+
+
+def fetch_dataframe_from_warehouse(
+    workspace_hostname: str,
+    access_token: str,
+    statement: str,
+    warnings: Optional[List[str]] = None
+) -> Optional[pd.DataFrame]:
+    """Genieが実行したステートメントをSQLウェアハウスで再実行してArrowで取得（失敗時はNone）"""
+    try:
+        with SQLWarehouseClient(
+            workspace_hostname,
+            os.getenv("DATABRICKS_WAREHOUSE_ID"),
+            access_token,
+            base_url=os.getenv("DATABRICKS_SQL_API_URL"),
+            max_workers=int(os.getenv("WAREHOUSE_FETCH_WORKERS", DEFAULT_MAX_WORKERS)),
+            max_rows=int(os.getenv("WAREHOUSE_FETCH_MAX_ROWS", DEFAULT_MAX_ROWS)),
+            max_bytes=int(os.getenv("WAREHOUSE_FETCH_MAX_BYTES", DEFAULT_MAX_BYTES))
+        ) as warehouse_client:
+            return warehouse_client.fetch_dataframe(statement)
+    except Exception as e:
+        report_warning(f"SQLウェアハウスからの結果取得に失敗したため、Genieの結果を表示します: {e}", warnings)
+        return None
+
+
+def query_genie_coalesced(workspace_hostname: str, genie_space_id: str, access_token: str, question: str) -> Dict[str, Any]:
+    """
+    Genieに質問して結果を解析（同じスペース・同じ質問が実行中なら、その結果を共有）
+
+    Returns:
+        df / executed_query / comment を含む辞書
+    """
+    def fetch() -> Dict[str, Any]:
+        # 結果は他のセッションと共有するため、警告は画面に出さず結果に含めて返す
+        # （キューの順番表示は実行中のセッション自身の画面にだけ出る）
+        warnings: List[str] = []
+        with GenieMCPClient(workspace_hostname, genie_space_id, access_token) as genie_client:
+            response = genie_client.query_genie(question)
+            #st.write("DEBUG: Genie response:", response)
+            result = GenieMCPResponseParser.parse_response(response)
+            #st.write("DEBUG: Parsed result:", result)
+            # 混雑によるタイムアウトなどの失敗は空の結果にせず、エラーとして呼び出し元に伝える
+            if not result["success"]:
+                raise RuntimeError(result["error"].get("message", "Genieからの応答がありません"))
+            executed_query = extract_query_from_genie_response(result, warnings)
+            df = None
+            # 大きな結果はSQLウェアハウスからArrowで取り直す
+            if executed_query and is_warehouse_fetch_enabled() and is_large_genie_result(result):
+                df = fetch_dataframe_from_warehouse(workspace_hostname, access_token, executed_query, warnings)
+            if df is None:
+                df = extract_dataframe_from_genie_response(result, genie_space_id, warnings)
+            return {
+                "df": df,
+                "executed_query": executed_query,
+                "comment": extract_comment_from_genie_response(result, warnings),
+                "warnings": warnings,
+            }
+
+    genie_result, shared = genie_single_flight.do(
+        (genie_space_id, normalize_question(question)),
+        fetch,
+        timeout=float(os.getenv("GENIE_COALESCE_TIMEOUT", 180))
+    )
+    for message in genie_result["warnings"]:
+        st.warning(message)
+    if shared:
+        st.caption("🔗 同じ質問が実行中だったため、その結果を共有しました")
+    return genie_result
+
+
 def genie_mcp_page(genie_space_id: str):
     """Genie MCP問い合わせページ"""
     st.title("🔍 Genie アドバイザー")
     st.markdown("Databricks Genie を使用してデータを取得し、AIとチャットで分析します")
-    workspace_hostname, username = get_workspace_info()
+    workspace_hostname = get_workspace_hostname()
     if not workspace_hostname:
         return
 
@@ -566,20 +906,16 @@ def genie_mcp_page(genie_space_id: str):
                     del st.session_state["analysis_comment"]
                 if "analysis_messages" in st.session_state:
                     del st.session_state["analysis_messages"]
+                if "analysis_context" in st.session_state:
+                    del st.session_state["analysis_context"]
+                cancel_speculative_followups()
                 
-                with GenieMCPClient(workspace_hostname, genie_space_id, access_token) as genie_client:
-                    with st.spinner("Genieに質問中..."):
-                        response = genie_client.query_genie(question)
-                        #st.write("DEBUG: Genie response:", response)
-                        result = GenieMCPResponseParser.parse_response(response)
-                        #st.write("DEBUG: Parsed result:", result)
-                        df = extract_dataframe_from_genie_response(result)
-                        executed_query = extract_query_from_genie_response(result)
-                        genie_comment = extract_comment_from_genie_response(result)
-                        st.session_state["genie_df"] = df
-                        st.session_state["genie_question"] = question
-                        st.session_state["genie_executed_query"] = executed_query
-                        st.session_state["genie_comment"] = genie_comment
+                with st.spinner("Genieに質問中..."), show_queue_position():
+                    genie_result = query_genie_coalesced(workspace_hostname, genie_space_id, access_token, question)
+                st.session_state["genie_df"] = genie_result["df"]
+                st.session_state["genie_question"] = question
+                st.session_state["genie_executed_query"] = genie_result["executed_query"]
+                st.session_state["genie_comment"] = genie_result["comment"]
             except Exception as e:
                 st.error(f"Genieへの問い合わせでエラー: {e}")
         else:
@@ -591,7 +927,13 @@ def genie_mcp_page(genie_space_id: str):
 
 
 def main():
+    # Genie・LLM呼び出しのユーザーごとの上限に使う
+    set_current_user(get_user_key())
     genie_mcp_page(genie_space_id)
+    mark_first_paint()
+    # 初回描画後に重いモジュールとLLMクライアントを裏で準備しておく
+    start_background_warmup(callbacks=(get_deploy_client,))
+    show_import_report()
 
 if __name__ == "__main__":
     main()
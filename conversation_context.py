@@ -0,0 +1,156 @@
+"""
+Conversation Context
+分析チャットの会話コンテキストを管理するクラス
+データプロファイルと元の質問を固定のプレフィックスとして保持し、
+会話ターンを追記していく。トークン予算を超えた古いターンは要約にまとめる
+"""
+
+import threading
+from typing import Callable, Dict, List, Optional
+
+
+# 1トークンあたりのおおよそのバイト数（日本語混在テキスト向けの概算）
+BYTES_PER_TOKEN = 3
+DEFAULT_TOKEN_BUDGET = 3000
+DEFAULT_KEEP_RECENT_TURNS = 2
+MAX_SUMMARY_CHARS = 1200
+
+Message = Dict[str, str]
+Summarizer = Callable[[str, List[Message]], str]
+
+
+def estimate_tokens(text: str) -> int:
+    """テキストのトークン数を概算"""
+    if not text:
+        return 0
+    return max(1, len(text.encode("utf-8")) // BYTES_PER_TOKEN)
+
+
+def extractive_summary(previous_summary: str, messages: List[Message]) -> str:
+    """
+    LLMを使わずに古いターンを要約（各発言の先頭を残す）
+
+    Args:
+        previous_summary: これまでの要約
+        messages: 要約に追加するメッセージ
+
+    Returns:
+        更新された要約
+    """
+    lines = [previous_summary] if previous_summary else []
+    for msg in messages:
+        speaker = "ユーザー" if msg["role"] == "user" else "AI"
+        content = " ".join(msg["content"].split())
+        if len(content) > 120:
+            content = content[:120] + "…"
+        lines.append(f"- {speaker}: {content}")
+    summary = "\n".join(lines)
+    if len(summary) > MAX_SUMMARY_CHARS:
+        summary = "…" + summary[-MAX_SUMMARY_CHARS:]
+    return summary
+
+
+class AnalysisConversation:
+    """データ分析チャットの会話コンテキスト"""
+
+    def __init__(
+        self,
+        data_profile: str,
+        original_question: str,
+        token_budget: int = DEFAULT_TOKEN_BUDGET,
+        keep_recent_turns: int = DEFAULT_KEEP_RECENT_TURNS,
+        summarizer: Optional[Summarizer] = None
+    ):
+        """
+        会話コンテキストを初期化
+
+        Args:
+            data_profile: データの概要・サンプル・統計を含むテキスト
+            original_question: Genieへの元の質問
+            token_budget: 要約を除く会話ターンに使うトークン予算
+            keep_recent_turns: 要約せずに残す直近のターン数
+            summarizer: 古いターンを要約する関数（失敗時は抽出的要約を使用）
+        """
+        self.original_question = original_question
+        self.token_budget = token_budget
+        self.keep_recent_turns = keep_recent_turns
+        self.summarizer = summarizer
+        # プレフィックスは会話中に変化させない（プレフィックスキャッシュを効かせるため）
+        self.prefix: List[Message] = [{
+            "role": "system",
+            "content": (
+                "あなたはデータアナリストです。以下のデータについてユーザーの質問に答えてください。\n\n"
+                f"元の質問: {original_question}\n\n{data_profile}"
+            )
+        }]
+        self.summary = ""
+        self.turns: List[Message] = []
+        self._lock = threading.Lock()
+
+    @property
+    def turn_tokens(self) -> int:
+        """要約されていない会話ターンのトークン数"""
+        return sum(estimate_tokens(msg["content"]) for msg in self.turns)
+
+    def build_messages(self, user_content: str) -> List[Message]:
+        """
+        LLMに送信するメッセージを組み立て
+
+        Args:
+            user_content: 今回のユーザーメッセージ
+
+        Returns:
+            プレフィックス、要約、直近のターン、今回のメッセージの順に並んだリスト
+        """
+        with self._lock:
+            messages = list(self.prefix)
+            if self.summary:
+                messages.append({"role": "user", "content": f"これまでの会話の要約:\n{self.summary}"})
+                messages.append({"role": "assistant", "content": "承知しました。要約を踏まえて回答します。"})
+            messages.extend(self.turns)
+        messages.append({"role": "user", "content": user_content})
+        return messages
+
+    def add_turn(self, user_content: str, assistant_content: str):
+        """
+        会話ターンを追加し、予算を超えていれば古いターンを要約
+
+        Args:
+            user_content: ユーザーの発言
+            assistant_content: AIの回答
+        """
+        with self._lock:
+            self.turns.append({"role": "user", "content": user_content})
+            self.turns.append({"role": "assistant", "content": assistant_content})
+            if self.turn_tokens <= self.token_budget:
+                return
+            keep = self.keep_recent_turns * 2
+            if len(self.turns) <= keep:
+                return
+            old_turns = self.turns[:len(self.turns) - keep]
+            previous_summary = self.summary
+
+        # 要約はLLM呼び出しを伴うため、ロックの外で行う
+        summary = self._summarize(previous_summary, old_turns)
+
+        with self._lock:
+            # 要約中に他のスレッドが要約・リセットした場合は結果を捨てる
+            if self.summary == previous_summary and self.turns[:len(old_turns)] == old_turns:
+                self.turns = self.turns[len(old_turns):]
+                self.summary = summary
+
+    def _summarize(self, previous_summary: str, old_turns: List[Message]) -> str:
+        """古いターンを要約（要約関数が失敗した場合は抽出的要約）"""
+        summary = None
+        if self.summarizer:
+            try:
+                summary = self.summarizer(previous_summary, old_turns)
+            except Exception:
+                summary = None
+        return summary or extractive_summary(previous_summary, old_turns)
+
+    def reset(self):
+        """会話ターンと要約をクリア（プレフィックスは保持）"""
+        with self._lock:
+            self.summary = ""
+            self.turns = []
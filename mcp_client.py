@@ -4,11 +4,16 @@ Databricks Genie MCPサーバーとの通信を行うクライアントクラス
 """
 
 import json
-import requests
 import uuid
 from typing import Dict, Any, List, Optional
 from dataclasses import dataclass
 
+from startup import lazy_module
+from admission_control import AdmissionTimeout, genie_admission
+
+# requestsは最初のリクエスト時にインポート
+requests = lazy_module("requests")
+
 
 @dataclass
 class MCPRequest:
@@ -72,11 +77,13 @@ class GenieMCPClient:
             MCPレスポンスオブジェクト
         """
         try:
-            response = self.session.post(
-                self.base_url,
-                json=request.__dict__,
-                timeout=60
-            )
+            # プロセス全体のレート・同時実行数の上限内で送信
+            with genie_admission.admit():
+                response = self.session.post(
+                    self.base_url,
+                    json=request.__dict__,
+                    timeout=60
+                )
             
             if response.status_code == 200:
                 data = response.json()
@@ -90,6 +97,14 @@ class GenieMCPClient:
                     }
                 )
                 
+        except AdmissionTimeout as e:
+            return MCPResponse(
+                id=request.id,
+                error={
+                    "code": 429,
+                    "message": str(e)
+                }
+            )
         except requests.exceptions.Timeout:
             return MCPResponse(
                 id=request.id,
@@ -1,11 +1,27 @@
-from mlflow.deployments import get_deploy_client
+import threading
+
+from startup import lazy_import
+from admission_control import llm_admission
+
+_deploy_client = None
+_deploy_client_lock = threading.Lock()
+
+def get_deploy_client():
+    """Returns the Databricks deployments client, importing mlflow on first use."""
+    global _deploy_client
+    if _deploy_client is None:
+        with _deploy_client_lock:
+            if _deploy_client is None:
+                _deploy_client = lazy_import("mlflow.deployments").get_deploy_client('databricks')
+    return _deploy_client
 
 def _query_endpoint(endpoint_name: str, messages: list[dict[str, str]], max_tokens) -> list[dict[str, str]]:
     """Calls a model serving endpoint."""
-    res = get_deploy_client('databricks').predict(
-        endpoint=endpoint_name,
-        inputs={'messages': messages, "max_tokens": max_tokens},
-    )
+    with llm_admission.admit():
+        res = get_deploy_client().predict(
+            endpoint=endpoint_name,
+            inputs={'messages': messages, "max_tokens": max_tokens},
+        )
     if "messages" in res:
         return res["messages"]
     elif "choices" in res:
@@ -0,0 +1,98 @@
+"""
+Request Coalescing
+同じキーの処理が実行中の場合に、後続の呼び出しを1つの上流呼び出しの結果で待ち合わせる
+（シングルフライト）ユーティリティ
+"""
+
+import threading
+import time
+import unicodedata
+from typing import Any, Callable, Dict, Hashable, Optional, Tuple
+
+
+class CoalescedRequestTimeout(TimeoutError):
+    """実行中の同一リクエストの完了を待つ間にタイムアウトした場合の例外"""
+
+
+class _Call:
+    __slots__ = ("done", "result", "error", "abandoned")
+
+    def __init__(self):
+        self.done = threading.Event()
+        self.result: Any = None
+        self.error: Optional[Exception] = None
+        # 実行中の呼び出しが中断された（結果を共有できない）場合True
+        self.abandoned = False
+
+
+def normalize_question(question: str) -> str:
+    """全角・半角、大文字・小文字、空白の違いを吸収した質問文"""
+    return " ".join(unicodedata.normalize("NFKC", question).casefold().split())
+
+
+class SingleFlight:
+    """同じキーの同時呼び出しを1回の実行にまとめるクラス"""
+
+    def __init__(self):
+        self._calls: Dict[Hashable, _Call] = {}
+        self._lock = threading.Lock()
+
+    def do(self, key: Hashable, fn: Callable[[], Any], timeout: Optional[float] = None) -> Tuple[Any, bool]:
+        """
+        キーごとに1回だけfnを実行し、同時に来た呼び出しには同じ結果を返す
+
+        Args:
+            key: 呼び出しをまとめるキー
+            fn: 実行する処理
+            timeout: 実行中の呼び出しの完了を待つ最大秒数（Noneの場合は無制限）
+
+        Returns:
+            (結果, 他の呼び出しの結果を共有した場合True)
+
+        Raises:
+            CoalescedRequestTimeout: 待機がタイムアウトした場合
+            fnが送出した例外（Exceptionは待っていたすべての呼び出しに伝播する）
+        """
+        deadline = None if timeout is None else time.monotonic() + timeout
+        while True:
+            with self._lock:
+                call = self._calls.get(key)
+                if call is None:
+                    call = _Call()
+                    self._calls[key] = call
+                    break
+
+            remaining = None if deadline is None else max(0.0, deadline - time.monotonic())
+            if not call.done.wait(remaining):
+                raise CoalescedRequestTimeout("実行中の同じリクエストの完了待ちがタイムアウトしました")
+            # 実行中の呼び出しが中断された場合は、待っていた呼び出しのどれかが実行し直す
+            if call.abandoned:
+                continue
+            if call.error is not None:
+                raise call.error
+            return call.result, True
+
+        try:
+            call.result = fn()
+        except Exception as e:
+            call.error = e
+            raise
+        except BaseException:
+            # 中断（KeyboardInterruptやスクリプトの停止など）は呼び出し元固有なので共有しない
+            call.abandoned = True
+            raise
+        finally:
+            # 完了したキーは外し、以降の呼び出しは新たに実行する
+            with self._lock:
+                self._calls.pop(key, None)
+            call.done.set()
+        return call.result, False
+
+    def in_flight(self) -> int:
+        """実行中のキーの数"""
+        with self._lock:
+            return len(self._calls)
+
+
+# Genieへの質問用（プロセス共通）
+genie_single_flight = SingleFlight()
@@ -0,0 +1,206 @@
+"""
+Result Viewer
+大きなクエリー結果を扱うためのページング・ソートとエクスポート機能
+ブラウザには表示中のページだけを送り、エクスポートはチャンク単位で書き出す
+"""
+
+from __future__ import annotations
+
+import io
+import math
+import os
+import tempfile
+from typing import Dict, Iterator, Optional, Tuple
+
+from startup import lazy_module
+
+pd = lazy_module("pandas")
+pa = lazy_module("pyarrow")
+pq = lazy_module("pyarrow.parquet")
+
+
+DEFAULT_PAGE_SIZE = 100
+PAGE_SIZE_OPTIONS = [50, 100, 500, 1000]
+DEFAULT_CHUNK_ROWS = 50_000
+
+EXPORT_FORMATS: Dict[str, Dict[str, str]] = {
+    "parquet": {"label": "Parquet", "extension": "parquet", "mime": "application/vnd.apache.parquet"},
+    "arrow": {"label": "Arrow IPC", "extension": "arrows", "mime": "application/vnd.apache.arrow.stream"},
+    "csv": {"label": "CSV", "extension": "csv", "mime": "text/csv"},
+}
+
+
+class ResultPager:
+    """キャッシュされたDataFrameをサーバー側でソート・ページングするクラス"""
+
+    def __init__(self, df: pd.DataFrame):
+        """
+        Args:
+            df: 表示対象のDataFrame
+        """
+        self.df = df
+        self._orders: Dict[Tuple[str, bool], object] = {}
+
+    @property
+    def row_count(self) -> int:
+        return len(self.df)
+
+    def page_count(self, page_size: int) -> int:
+        """ページ数（空の場合も1ページ）"""
+        return max(1, math.ceil(self.row_count / page_size))
+
+    def _sorted_positions(self, column: str, ascending: bool):
+        """列でソートした行位置（ソート条件ごとにキャッシュ）"""
+        key = (column, ascending)
+        if key not in self._orders:
+            values = self.df[column].reset_index(drop=True)
+            try:
+                ordered = values.sort_values(ascending=ascending, kind="stable", na_position="last")
+            except TypeError:
+                # 型が混在した列は文字列として比較する
+                ordered = values.sort_values(
+                    ascending=ascending, kind="stable", na_position="last",
+                    key=lambda s: s.astype(str).where(s.notna())
+                )
+            self._orders[key] = ordered.index.to_numpy()
+        return self._orders[key]
+
+    def page(
+        self,
+        page: int,
+        page_size: int,
+        sort_by: Optional[str] = None,
+        ascending: bool = True
+    ) -> pd.DataFrame:
+        """
+        指定ページの行だけを取り出す
+
+        Args:
+            page: ページ番号（1始まり）
+            page_size: 1ページあたりの行数
+            sort_by: ソートする列名（Noneの場合は元の順序）
+            ascending: 昇順の場合True
+
+        Returns:
+            表示するページのDataFrame
+        """
+        page = min(max(1, page), self.page_count(page_size))
+        start = (page - 1) * page_size
+        end = start + page_size
+        if sort_by is None:
+            return self.df.iloc[start:end]
+        return self.df.iloc[self._sorted_positions(sort_by, ascending)[start:end]]
+
+
+class _ChunkSink(io.RawIOBase):
+    """書き込まれたバイト列をチャンクとして取り出せる出力先（位置は累計で保持）"""
+
+    def __init__(self):
+        super().__init__()
+        self._chunks = []
+        self._position = 0
+
+    def writable(self) -> bool:
+        return True
+
+    def write(self, data) -> int:
+        data = bytes(data)
+        self._chunks.append(data)
+        self._position += len(data)
+        return len(data)
+
+    def tell(self) -> int:
+        return self._position
+
+    def drain(self) -> bytes:
+        """これまでに書き込まれたバイト列を取り出して破棄"""
+        data = b"".join(self._chunks)
+        self._chunks = []
+        return data
+
+
+def _arrow_schema(df: pd.DataFrame):
+    """全体から推定したスキーマ（チャンクごとの型ぶれを防ぐ）"""
+    return pa.Schema.from_pandas(df, preserve_index=False)
+
+
+def iter_export_chunks(
+    df: pd.DataFrame,
+    fmt: str,
+    chunk_rows: int = DEFAULT_CHUNK_ROWS
+) -> Iterator[bytes]:
+    """
+    DataFrameを指定フォーマットでチャンクごとにエンコード
+
+    Args:
+        df: エクスポートするDataFrame
+        fmt: "parquet" / "arrow" / "csv"
+        chunk_rows: 1チャンクあたりの行数
+
+    Yields:
+        エンコードされたバイト列
+    """
+    if fmt not in EXPORT_FORMATS:
+        raise ValueError(f"Unsupported export format: {fmt}")
+
+    if fmt == "csv":
+        for start in range(0, max(len(df), 1), chunk_rows):
+            chunk = df.iloc[start:start + chunk_rows]
+            yield chunk.to_csv(index=False, header=(start == 0)).encode("utf-8")
+        return
+
+    schema = _arrow_schema(df)
+    sink = _ChunkSink()
+    if fmt == "parquet":
+        writer = pq.ParquetWriter(sink, schema)
+    else:
+        writer = pa.ipc.new_stream(sink, schema)
+    try:
+        for start in range(0, len(df), chunk_rows):
+            chunk = df.iloc[start:start + chunk_rows]
+            writer.write_table(pa.Table.from_pandas(chunk, schema=schema, preserve_index=False))
+            data = sink.drain()
+            if data:
+                yield data
+    finally:
+        writer.close()
+    data = sink.drain()
+    if data:
+        yield data
+
+
+def export_dataframe(
+    df: pd.DataFrame,
+    fmt: str,
+    chunk_rows: int = DEFAULT_CHUNK_ROWS
+) -> bytes:
+    """
+    DataFrameをエクスポートしたバイト列を作成
+    エンコード中はチャンクごとに一時ファイルへ書き出すため、中間データはチャンク分に収まる
+    （出力全体のバイト列はダウンロードのためにメモリに保持される）
+
+    Args:
+        df: エクスポートするDataFrame
+        fmt: "parquet" / "arrow" / "csv"
+        chunk_rows: 1チャンクあたりの行数
+
+    Returns:
+        エクスポートしたファイルの内容
+    """
+    with tempfile.NamedTemporaryFile(suffix=f".{EXPORT_FORMATS[fmt]['extension']}", delete=False) as tmp:
+        path = tmp.name
+        try:
+            for data in iter_export_chunks(df, fmt, chunk_rows):
+                tmp.write(data)
+        except BaseException:
+            tmp.close()
+            os.unlink(path)
+            raise
+    try:
+        with open(path, "rb") as exported:
+            return exported.read()
+    finally:
+        try:
+            os.unlink(path)
+        except OSError:
+            pass
@@ -0,0 +1,191 @@
+"""
+Speculative Follow-up
+AIが提案した追加質問への回答をバックグラウンドで先読みするユーティリティ
+プロセス共通の上限付きスレッドプールで実行し、ユーザーごとの予算を超えないようにする
+"""
+
+import contextvars
+import os
+import threading
+import time
+from collections import deque
+from concurrent.futures import Future, ThreadPoolExecutor, TimeoutError as FutureTimeoutError
+from typing import Callable, Deque, Dict, Iterable, Optional
+
+from admission_control import get_current_user, queue_feedback, set_current_user
+
+
+DEFAULT_MAX_WORKERS = 2
+# ユーザーごとの先読み回数の上限（DEFAULT_BUDGET_WINDOW秒あたり）
+DEFAULT_BUDGET_PER_USER = 12
+DEFAULT_BUDGET_WINDOW = 3600
+# 先読みはユーザー本人の呼び出しとは別の枠でアドミッション制御する
+SPECULATIVE_USER_SUFFIX = ":speculative"
+
+_executor: Optional[ThreadPoolExecutor] = None
+_executor_lock = threading.Lock()
+
+
+def is_speculation_enabled() -> bool:
+    """環境変数で先読みモードが有効になっているか"""
+    return os.getenv("SPECULATIVE_FOLLOWUPS", "false").lower() in ("1", "true", "yes")
+
+
+def _get_executor() -> ThreadPoolExecutor:
+    """先読み用の共有スレッドプールを取得（初回に作成）"""
+    global _executor
+    with _executor_lock:
+        if _executor is None:
+            _executor = ThreadPoolExecutor(
+                max_workers=int(os.getenv("SPECULATIVE_MAX_WORKERS", DEFAULT_MAX_WORKERS)),
+                thread_name_prefix="speculative-followup"
+            )
+        return _executor
+
+
+class SpeculationBudget:
+    """ユーザーごとの先読み回数をスライディングウィンドウで制限するクラス"""
+
+    def __init__(self, limit: int, window_seconds: float):
+        """
+        Args:
+            limit: ウィンドウ内で許可する先読み回数
+            window_seconds: ウィンドウの長さ（秒）
+        """
+        self.limit = limit
+        self.window_seconds = window_seconds
+        self._usage: Dict[str, Deque[float]] = {}
+        self._lock = threading.Lock()
+
+    def _prune(self, user_key: str, now: float) -> Deque[float]:
+        usage = self._usage.setdefault(user_key, deque())
+        while usage and now - usage[0] > self.window_seconds:
+            usage.popleft()
+        return usage
+
+    def try_acquire(self, user_key: str) -> bool:
+        """予算が残っていれば1回分を消費してTrueを返す"""
+        with self._lock:
+            now = time.monotonic()
+            usage = self._prune(user_key, now)
+            if len(usage) >= self.limit:
+                return False
+            usage.append(now)
+            return True
+
+    def refund(self, user_key: str):
+        """実行されなかった先読み1回分を返却"""
+        with self._lock:
+            usage = self._usage.get(user_key)
+            if usage:
+                usage.pop()
+
+    def remaining(self, user_key: str) -> int:
+        """ウィンドウ内の残り回数"""
+        with self._lock:
+            return max(0, self.limit - len(self._prune(user_key, time.monotonic())))
+
+
+_budget = SpeculationBudget(
+    limit=int(os.getenv("SPECULATIVE_BUDGET_PER_USER", DEFAULT_BUDGET_PER_USER)),
+    window_seconds=float(os.getenv("SPECULATIVE_BUDGET_WINDOW", DEFAULT_BUDGET_WINDOW))
+)
+
+
+class SpeculativeFollowups:
+    """1セッション分の追加質問の先読み回答を管理するクラス"""
+
+    def __init__(self, user_key: str, budget: SpeculationBudget = _budget):
+        """
+        Args:
+            user_key: 予算を管理するユーザーのキー
+            budget: ユーザーごとの先読み予算
+        """
+        self.user_key = user_key
+        self.budget = budget
+        self.generation = 0
+        self._futures: Dict[str, Future] = {}
+        self._lock = threading.Lock()
+
+    def start(self, questions: Iterable[str], answer_fn: Callable[[str], str]) -> int:
+        """
+        質問への回答の先読みを開始
+
+        Args:
+            questions: 先読みする質問
+            answer_fn: 質問を受け取り回答を返す関数（失敗時は例外を送出）
+
+        Returns:
+            開始した先読みの数
+        """
+        started = 0
+        with self._lock:
+            generation = self.generation
+            for question in questions:
+                if question in self._futures:
+                    continue
+                if not self.budget.try_acquire(self.user_key):
+                    break
+                # 呼び出し元のユーザー情報などのコンテキストを引き継いで実行
+                context = contextvars.copy_context()
+                self._futures[question] = _get_executor().submit(
+                    context.run, self._run, generation, question, answer_fn
+                )
+                started += 1
+        return started
+
+    def _run(self, generation: int, question: str, answer_fn: Callable[[str], str]) -> str:
+        # キューで待っている間にデータが差し替えられた場合は実行しない
+        if generation != self.generation:
+            raise RuntimeError("Speculation cancelled")
+        # ユーザー本人の質問が先読みの後ろで待たされないよう別の枠を使い、
+        # 終了済みのスクリプト実行のUIにはキューの順番を通知しない
+        set_current_user(get_current_user() + SPECULATIVE_USER_SUFFIX)
+        with queue_feedback(None):
+            return answer_fn(question)
+
+    def status(self, question: str) -> Optional[str]:
+        """先読みの状態（"ready" / "running" / None）"""
+        with self._lock:
+            future = self._futures.get(question)
+        if future is None or future.cancelled():
+            return None
+        if not future.done():
+            return "running"
+        return "ready" if future.exception() is None else None
+
+    def get(self, question: str, timeout: Optional[float] = None) -> Optional[str]:
+        """
+        先読みした回答を取得
+
+        Args:
+            question: 質問
+            timeout: 実行中の先読みを待つ最大秒数
+
+        Returns:
+            回答。先読みしていない、失敗した、または時間内に終わらない場合None
+        """
+        with self._lock:
+            future = self._futures.get(question)
+        if future is None or future.cancelled():
+            return None
+        # まだキューで待っている場合は取り消して、呼び出し側で直接回答を生成させる
+        if not future.running() and not future.done():
+            if future.cancel():
+                self.budget.refund(self.user_key)
+                return None
+        try:
+            return future.result(timeout=timeout)
+        except FutureTimeoutError:
+            return None
+        except Exception:
+            return None
+
+    def cancel(self):
+        """すべての先読みを破棄し、未実行のものは予算を返却"""
+        with self._lock:
+            self.generation += 1
+            for future in self._futures.values():
+                if future.cancel():
+                    self.budget.refund(self.user_key)
+            self._futures = {}
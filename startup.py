@@ -0,0 +1,165 @@
+"""
+Startup Utilities
+重いモジュールの遅延インポート、初回描画後のバックグラウンドウォームアップ、
+インポート時間レポートを提供するユーティリティ
+"""
+
+import importlib
+import sys
+import threading
+import time
+from types import ModuleType
+from typing import Callable, Dict, Iterable, List, Optional
+
+
+# 初回描画後にバックグラウンドで読み込んでおくモジュール
+WARMUP_MODULES = (
+    "pandas",
+    "requests",
+    "databricks.sdk",
+    "mlflow.deployments",
+)
+
+# プロセス内で最初にこのモジュールが読み込まれた時刻（起動時間の基準）
+PROCESS_START = time.perf_counter()
+PROCESS_START_WALL = time.time()
+
+_first_paint: Optional[float] = None
+_import_times: Dict[str, float] = {}
+_import_lock = threading.Lock()
+_warmup_thread: Optional[threading.Thread] = None
+_warmup_errors: Dict[str, str] = {}
+
+
+def lazy_import(name: str) -> ModuleType:
+    """
+    モジュールをインポートし、初回インポートにかかった時間を記録
+
+    Args:
+        name: インポートするモジュール名
+
+    Returns:
+        インポートされたモジュール
+    """
+    # 別スレッドがインポート中の場合もモジュールごとのロックで完了を待つため、
+    # sys.modulesにあっても必ずimport_moduleを経由する
+    first_import = name not in sys.modules
+    start = time.perf_counter()
+    module = importlib.import_module(name)
+    elapsed = time.perf_counter() - start
+    if first_import:
+        with _import_lock:
+            _import_times.setdefault(name, elapsed)
+    return module
+
+
+class LazyModule(ModuleType):
+    """属性に初めてアクセスされた時点で実モジュールをインポートするプロキシ"""
+
+    def __init__(self, name: str):
+        super().__init__(name)
+        self.__dict__["_lazy_target"] = None
+
+    def _load(self) -> ModuleType:
+        target = self.__dict__["_lazy_target"]
+        if target is None:
+            target = lazy_import(self.__name__)
+            self.__dict__["_lazy_target"] = target
+        return target
+
+    def __getattr__(self, attr: str):
+        return getattr(self._load(), attr)
+
+    def __dir__(self):
+        return dir(self._load())
+
+    def __repr__(self) -> str:
+        state = "loaded" if self.__dict__["_lazy_target"] is not None else "not loaded"
+        return f"<lazy module '{self.__name__}' ({state})>"
+
+
+def lazy_module(name: str) -> LazyModule:
+    """
+    遅延インポート用のモジュールプロキシを作成
+
+    Args:
+        name: モジュール名
+
+    Returns:
+        初回の属性アクセスでインポートされるプロキシ
+    """
+    return LazyModule(name)
+
+
+def _warmup(modules: Iterable[str], callbacks: Iterable[Callable[[], None]]):
+    """バックグラウンドスレッド本体"""
+    for name in modules:
+        try:
+            lazy_import(name)
+        except Exception as e:
+            _warmup_errors[name] = str(e)
+    for callback in callbacks:
+        try:
+            callback()
+        except Exception as e:
+            _warmup_errors[getattr(callback, "__name__", repr(callback))] = str(e)
+
+
+def start_background_warmup(
+    modules: Iterable[str] = WARMUP_MODULES,
+    callbacks: Iterable[Callable[[], None]] = ()
+) -> threading.Thread:
+    """
+    重いモジュールのインポートとクライアント生成をバックグラウンドで開始
+    プロセス内で一度だけ実行され、2回目以降は既存のスレッドを返す
+
+    Args:
+        modules: 事前にインポートするモジュール名
+        callbacks: インポート後に実行するウォームアップ処理
+
+    Returns:
+        ウォームアップスレッド
+    """
+    global _warmup_thread
+    with _import_lock:
+        if _warmup_thread is None:
+            _warmup_thread = threading.Thread(
+                target=_warmup,
+                args=(tuple(modules), tuple(callbacks)),
+                name="startup-warmup",
+                daemon=True
+            )
+            _warmup_thread.start()
+        return _warmup_thread
+
+
+def mark_first_paint():
+    """最初の画面描画が終わった時刻を記録（プロセス内で最初の1回のみ）"""
+    global _first_paint
+    with _import_lock:
+        if _first_paint is None:
+            _first_paint = time.perf_counter()
+
+
+def get_first_paint_seconds() -> Optional[float]:
+    """プロセス起動から最初の画面描画までの秒数（未描画の場合None）"""
+    with _import_lock:
+        if _first_paint is None:
+            return None
+        return _first_paint - PROCESS_START
+
+
+def get_import_report() -> List[Dict[str, object]]:
+    """
+    遅延インポートされたモジュールのインポート時間レポートを取得
+
+    Returns:
+        所要時間の降順に並んだ {"module", "seconds"} のリスト
+    """
+    with _import_lock:
+        items = list(_import_times.items())
+    report = [{"module": name, "seconds": round(seconds, 3)} for name, seconds in items]
+    report.sort(key=lambda item: item["seconds"], reverse=True)
+    for name, message in _warmup_errors.items():
+        report.append({"module": name, "seconds": None, "error": message})
+    return report
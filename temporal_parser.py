@@ -0,0 +1,212 @@
+"""
+Temporal Parser
+Genieの結果列を日付・時刻型に変換するパーサー
+マニフェストの列型を優先し、型が不明な文字列列はサンプルからフォーマットを推定して
+明示的なフォーマットでベクトル化パースする
+"""
+
+from __future__ import annotations
+
+import threading
+from collections import OrderedDict
+from datetime import datetime
+from typing import Dict, Any, List, Optional, Tuple
+
+from startup import lazy_module
+
+pd = lazy_module("pandas")
+
+
+# マニフェストで日付・時刻を表す型
+TEMPORAL_TYPES = {"DATE", "TIMESTAMP", "TIMESTAMP_NTZ"}
+# サンプル推定の対象にする型（型情報がない列も対象）
+INFERABLE_TYPES = {"STRING", "CHAR", "VARCHAR"}
+
+# サンプル推定で試すフォーマット（区切り文字を含むもののみ。数値だけの列は対象外）
+CANDIDATE_FORMATS = [
+    "%Y-%m-%d",
+    "%Y-%m-%d %H:%M:%S",
+    "%Y-%m-%dT%H:%M:%S",
+    "%Y-%m-%d %H:%M:%S.%f",
+    "%Y-%m-%dT%H:%M:%S.%f",
+    "%Y-%m-%d %H:%M",
+    "%Y-%m",
+    "%Y/%m/%d",
+    "%Y/%m/%d %H:%M:%S",
+    "%Y/%m/%d %H:%M",
+    "%Y/%m",
+    "%Y年%m月%d日",
+    "%Y年%m月",
+    "%m/%d/%Y",
+    "%d/%m/%Y",
+]
+# タイムゾーン付きISO 8601文字列用（pandasの高速パス）
+ISO8601 = "ISO8601"
+
+DEFAULT_SAMPLE_SIZE = 20
+MAX_CACHE_ENTRIES = 1024
+
+_format_cache: "OrderedDict[Tuple[str, str], str]" = OrderedDict()
+_cache_lock = threading.Lock()
+
+
+def _get_cached_format(space_id: str, column: str) -> Optional[str]:
+    with _cache_lock:
+        fmt = _format_cache.get((space_id, column))
+        if fmt is not None:
+            _format_cache.move_to_end((space_id, column))
+        return fmt
+
+
+def _set_cached_format(space_id: str, column: str, fmt: Optional[str]):
+    with _cache_lock:
+        if fmt is None:
+            _format_cache.pop((space_id, column), None)
+            return
+        _format_cache[(space_id, column)] = fmt
+        _format_cache.move_to_end((space_id, column))
+        while len(_format_cache) > MAX_CACHE_ENTRIES:
+            _format_cache.popitem(last=False)
+
+
+def clear_format_cache():
+    """フォーマットキャッシュをクリア"""
+    with _cache_lock:
+        _format_cache.clear()
+
+
+def _sample_values(series: pd.Series, sample_size: int) -> List[Any]:
+    """列全体から均等に非NULL値をサンプリング"""
+    non_null = series.dropna()
+    if non_null.empty:
+        return []
+    step = max(1, len(non_null) // sample_size)
+    return non_null.iloc[::step].iloc[:sample_size].tolist()
+
+
+def _is_iso8601_with_tz(value: str) -> bool:
+    if not ("T" in value or " " in value):
+        return False
+    if not (value.endswith("Z") or value[-6:-5] in ("+", "-")):
+        return False
+    try:
+        datetime.fromisoformat(value)
+        return True
+    except ValueError:
+        return False
+
+
+def infer_datetime_format(values: List[Any]) -> Optional[str]:
+    """
+    サンプル値からすべての値に一致する日付フォーマットを推定
+
+    Args:
+        values: サンプル値のリスト
+
+    Returns:
+        strptime形式のフォーマット文字列、"ISO8601"、または一致しない場合None
+    """
+    if not values or not all(isinstance(v, str) for v in values):
+        return None
+    samples = [v.strip() for v in values]
+
+    if all(_is_iso8601_with_tz(v) for v in samples):
+        return ISO8601
+
+    for fmt in CANDIDATE_FORMATS:
+        try:
+            for v in samples:
+                datetime.strptime(v, fmt)
+        except ValueError:
+            continue
+        return fmt
+    return None
+
+
+def _to_datetime(series: pd.Series, fmt: str) -> pd.Series:
+    """明示的なフォーマットでベクトル化パースし、naiveなUTC時刻に揃える"""
+    parsed = pd.to_datetime(series, format=fmt, errors="coerce", utc=True)
+    return parsed.dt.tz_convert(None)
+
+
+def parse_temporal_column(
+    series: pd.Series,
+    space_id: str,
+    column: str,
+    type_name: Optional[str] = None,
+    sample_size: int = DEFAULT_SAMPLE_SIZE
+) -> Optional[pd.Series]:
+    """
+    列を日付・時刻型に変換
+
+    Args:
+        series: 変換対象の列
+        space_id: GenieスペースID（フォーマットキャッシュのキー）
+        column: 列名（フォーマットキャッシュのキー）
+        type_name: マニフェストの列型（不明な場合None）
+        sample_size: フォーマット推定に使うサンプル数
+
+    Returns:
+        変換後の列。日付・時刻列でない場合None
+    """
+    type_name = type_name.upper() if type_name else None
+
+    if type_name in TEMPORAL_TYPES:
+        parsed = _to_datetime(series, ISO8601)
+        return parsed if parsed.notna().any() or series.isna().all() else None
+    if type_name is not None and type_name not in INFERABLE_TYPES:
+        return None
+    if not (pd.api.types.is_object_dtype(series) or pd.api.types.is_string_dtype(series)):
+        return None
+
+    non_null = series.notna()
+    cached = _get_cached_format(space_id, column)
+    if cached is not None:
+        parsed = _to_datetime(series, cached)
+        # 新たなNaTが出なければキャッシュしたフォーマットをそのまま使う
+        if (parsed.notna() == non_null).all():
+            return parsed
+
+    samples = _sample_values(series, sample_size)
+    # サンプルから推定したフォーマットが列全体に合わない場合は、
+    # パースできなかった値をサンプルに加えて一度だけ推定し直す
+    for _ in range(2):
+        fmt = infer_datetime_format(samples)
+        if fmt is None:
+            break
+        parsed = _to_datetime(series, fmt)
+        failed = non_null & parsed.isna()
+        if not failed.any():
+            _set_cached_format(space_id, column, fmt)
+            return parsed if parsed.notna().any() else None
+        samples = samples + _sample_values(series[failed], sample_size)
+
+    # 一部の値が日付として解釈できない列は変換しない
+    _set_cached_format(space_id, column, None)
+    return None
+
+
+def parse_temporal_columns(
+    df: pd.DataFrame,
+    space_id: str,
+    column_types: Optional[Dict[str, Optional[str]]] = None
+) -> List[str]:
+    """
+    DataFrameの日付・時刻列をその場で変換
+
+    Args:
+        df: 変換対象のDataFrame
+        space_id: GenieスペースID
+        column_types: 列名からマニフェストの列型へのマップ
+
+    Returns:
+        変換された列名のリスト
+    """
+    column_types = column_types or {}
+    converted = []
+    for col in df.columns:
+        parsed = parse_temporal_column(df[col], space_id, col, column_types.get(col))
+        if parsed is not None:
+            df[col] = parsed
+            converted.append(col)
+    return converted
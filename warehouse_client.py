@@ -0,0 +1,221 @@
+"""
+SQL Warehouse Client
+SQL Statement Execution APIでステートメントを再実行し、結果をArrow形式で取得するクライアント
+大きなGenieの結果をJSONのdata_arrayではなく列指向のArrowチャンクとして並列ダウンロードする
+"""
+
+from __future__ import annotations
+
+import time
+from concurrent.futures import ThreadPoolExecutor
+from typing import Dict, Any, List, Optional, Tuple
+
+from startup import lazy_module
+
+requests = lazy_module("requests")
+pd = lazy_module("pandas")
+pa = lazy_module("pyarrow")
+
+
+TERMINAL_STATES = {"SUCCEEDED", "FAILED", "CANCELED", "CLOSED"}
+# (ダウンロードURL, URLと一緒に送る必要があるHTTPヘッダー)
+ChunkLink = Tuple[str, Dict[str, str]]
+DEFAULT_MAX_WORKERS = 4
+# アプリのメモリに読み込む結果の上限
+DEFAULT_MAX_ROWS = 1_000_000
+DEFAULT_MAX_BYTES = 512 * 1024 * 1024
+
+
+class WarehouseQueryError(Exception):
+    """ステートメントの実行または結果の取得に失敗した場合の例外"""
+
+
+class SQLWarehouseClient:
+    """SQLウェアハウスでステートメントを実行してArrowで結果を取得するクライアントクラス"""
+
+    def __init__(
+        self,
+        workspace_hostname: str,
+        warehouse_id: str,
+        access_token: str,
+        base_url: Optional[str] = None,
+        max_workers: int = DEFAULT_MAX_WORKERS,
+        max_rows: int = DEFAULT_MAX_ROWS,
+        max_bytes: int = DEFAULT_MAX_BYTES,
+        poll_interval: float = 1.0,
+        timeout: float = 300
+    ):
+        """
+        SQLウェアハウスクライアントを初期化
+
+        Args:
+            workspace_hostname: Databricksワークスペースのホスト名
+            warehouse_id: SQLウェアハウスのID
+            access_token: アクセストークン
+            base_url: APIのベースURL（ローカルのテスト用サーバーを使う場合に指定）
+            max_workers: チャンクを並列ダウンロードするスレッド数
+            max_rows: 取得する結果の最大行数（超える場合は取得しない）
+            max_bytes: 取得する結果の最大バイト数（超える場合は取得しない）
+            poll_interval: ステートメントの完了を確認する間隔（秒）
+            timeout: ステートメントの完了を待つ最大秒数
+        """
+        if base_url is None:
+            if workspace_hostname.startswith('https://'):
+                workspace_hostname = workspace_hostname[8:]
+            elif workspace_hostname.startswith('http://'):
+                workspace_hostname = workspace_hostname[7:]
+            base_url = f"https://{workspace_hostname}"
+        self.base_url = base_url.rstrip("/") + "/api/2.0/sql/statements"
+        self.warehouse_id = warehouse_id
+        self.max_workers = max_workers
+        self.max_rows = max_rows
+        self.max_bytes = max_bytes
+        self.poll_interval = poll_interval
+        self.timeout = timeout
+        self.session = requests.Session()
+        self.session.headers.update({
+            "Authorization": f"Bearer {access_token}",
+            "Content-Type": "application/json"
+        })
+        # 署名付きURLには認証ヘッダーを送らない
+        self.download_session = requests.Session()
+
+    def _request(self, method: str, url: str, **kwargs) -> Dict[str, Any]:
+        response = self.session.request(method, url, timeout=60, **kwargs)
+        if response.status_code != 200:
+            raise WarehouseQueryError(f"HTTP {response.status_code}: {response.text}")
+        return response.json()
+
+    def _submit(self, statement: str) -> Dict[str, Any]:
+        """ARROW_STREAM形式・EXTERNAL_LINKSでステートメントを送信"""
+        return self._request("POST", self.base_url, json={
+            "statement": statement,
+            "warehouse_id": self.warehouse_id,
+            "format": "ARROW_STREAM",
+            "disposition": "EXTERNAL_LINKS",
+            "wait_timeout": "30s",
+            "on_wait_timeout": "CONTINUE"
+        })
+
+    def _wait(self, response: Dict[str, Any]) -> Dict[str, Any]:
+        """ステートメントが終了状態になるまでポーリング"""
+        statement_id = response["statement_id"]
+        deadline = time.monotonic() + self.timeout
+        while response.get("status", {}).get("state") not in TERMINAL_STATES:
+            if time.monotonic() > deadline:
+                self.cancel(statement_id)
+                raise WarehouseQueryError("ステートメントの実行がタイムアウトしました")
+            time.sleep(self.poll_interval)
+            response = self._request("GET", f"{self.base_url}/{statement_id}")
+        status = response["status"]
+        if status["state"] != "SUCCEEDED":
+            message = status.get("error", {}).get("message", status["state"])
+            raise WarehouseQueryError(f"ステートメントの実行に失敗しました: {message}")
+        return response
+
+    @staticmethod
+    def _link_with_headers(link: Dict[str, Any]) -> ChunkLink:
+        return link["external_link"], link.get("http_headers") or {}
+
+    def _chunk_link(self, statement_id: str, chunk_index: int) -> ChunkLink:
+        """チャンクのダウンロードURLとヘッダーを取得（有効期限があるため直前に取得する）"""
+        data = self._request("GET", f"{self.base_url}/{statement_id}/result/chunks/{chunk_index}")
+        links = data.get("external_links") or []
+        if not links:
+            raise WarehouseQueryError(f"チャンク {chunk_index} のリンクがありません")
+        return self._link_with_headers(links[0])
+
+    def _download_chunk(self, statement_id: str, chunk_index: int, link: Optional[ChunkLink]):
+        """1チャンクをダウンロードしてArrowテーブルに変換"""
+        if link is None:
+            link = self._chunk_link(statement_id, chunk_index)
+        url, headers = link
+        response = self.download_session.get(url, headers=headers, timeout=300)
+        if response.status_code != 200:
+            raise WarehouseQueryError(f"チャンク {chunk_index} のダウンロードに失敗しました: HTTP {response.status_code}")
+        return pa.ipc.open_stream(response.content).read_all()
+
+    def fetch_arrow(self, statement: str):
+        """
+        ステートメントを実行し、結果をArrowテーブルとして取得
+
+        Args:
+            statement: 実行するSQL
+
+        Returns:
+            全チャンクを連結したpyarrow.Table
+
+        Raises:
+            WarehouseQueryError: 実行に失敗した場合、または結果が上限を超える場合
+        """
+        response = self._wait(self._submit(statement))
+        statement_id = response["statement_id"]
+        manifest = response.get("manifest", {})
+        total_rows = manifest.get("total_row_count", 0)
+        total_bytes = manifest.get("total_byte_count", 0)
+        if total_rows > self.max_rows or total_bytes > self.max_bytes:
+            raise WarehouseQueryError(
+                f"結果が大きすぎるため取得しません（{total_rows}行, {total_bytes}バイト）"
+            )
+        chunk_count = manifest.get("total_chunk_count", 0)
+        if chunk_count == 0:
+            return pa.table({
+                col["name"]: pa.array([], pa.null())
+                for col in manifest.get("schema", {}).get("columns", [])
+            })
+
+        # 最初のレスポンスに含まれるリンクはそのまま使う
+        known_links: Dict[int, ChunkLink] = {
+            link["chunk_index"]: self._link_with_headers(link)
+            for link in response.get("result", {}).get("external_links", [])
+        }
+        with ThreadPoolExecutor(max_workers=self.max_workers, thread_name_prefix="warehouse-fetch") as executor:
+            futures = [
+                executor.submit(self._download_chunk, statement_id, i, known_links.get(i))
+                for i in range(chunk_count)
+            ]
+            tables: List[Any] = [future.result() for future in futures]
+        return pa.concat_tables(tables)
+
+    def fetch_dataframe(self, statement: str) -> pd.DataFrame:
+        """
+        ステートメントを実行し、結果をDataFrameとして取得
+        数値列はArrowのバッファをそのまま参照し、文字列列はArrowベースの文字列型になる
+
+        Args:
+            statement: 実行するSQL
+
+        Returns:
+            結果のDataFrame（DECIMALはfloat64、タイムゾーン付きの時刻はnaiveなUTC時刻に変換）
+        """
+        table = self.fetch_arrow(statement)
+        # DECIMALはそのままだとDecimalオブジェクトの列になり数値列として扱われないため
+        schema = pa.schema([
+            field.with_type(pa.float64()) if pa.types.is_decimal(field.type) else field
+            for field in table.schema
+        ])
+        if not schema.equals(table.schema):
+            table = table.cast(schema)
+        df = table.to_pandas(date_as_object=False, split_blocks=True, self_destruct=True)
+        for col in df.columns:
+            if isinstance(df[col].dtype, pd.DatetimeTZDtype):
+                df[col] = df[col].dt.tz_convert(None)
+        return df
+
+    def cancel(self, statement_id: str):
+        """実行中のステートメントをキャンセル"""
+        try:
+            self.session.post(f"{self.base_url}/{statement_id}/cancel", timeout=10)
+        except requests.exceptions.RequestException:
+            pass
+
+    def close(self):
+        """セッションを閉じる"""
+        self.session.close()
+        self.download_session.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()